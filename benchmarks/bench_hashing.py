@@ -0,0 +1,61 @@
+"""Measures get_file_hash throughput (MB/s) per strategy, buffer size and file size.
+
+Usage: python benchmarks/bench_hashing.py [--dir DIR] [--sizes-mb 1 64 512] [--rounds 3]
+
+Files are hashed right after being written, so the numbers reflect the page cache rather than the disk:
+they compare the Python-side overhead of each strategy, which is what matters on fast NVMe sources.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))   # run from a checkout
+from savegame import utils  # noqa: E402
+
+BUFFER_SIZES = [8 * 1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    parser.add_argument('--sizes-mb', nargs='*', type=float, default=[0.1, 1, 64, 512])
+    parser.add_argument('--rounds', type=int, default=3)
+    return parser.parse_args()
+
+
+def create_file(dirname, size):
+    file = os.path.join(dirname, f'bench_hashing_{size}')
+    with open(file, 'wb') as fd:
+        for offset in range(0, size, 1024 * 1024):
+            fd.write(os.urandom(min(1024 * 1024, size - offset)))
+    return file
+
+
+def bench(file, size, strategy, buffer_size, rounds):
+    durations = []
+    for _ in range(rounds):
+        start_ts = time.perf_counter()
+        utils.get_file_hash(file, chunk_size=buffer_size, use_cache=False, strategy=strategy, use_service=False)
+        durations.append(time.perf_counter() - start_ts)
+    return size / min(durations) / 1024 / 1024
+
+
+def main():
+    args = parse_args()
+    print(f'{"size_MB":>10}  {"strategy":10}  {"buffer_KB":>10}  {"MB/s":>10}')
+    for size_mb in args.sizes_mb:
+        size = int(size_mb * 1024 * 1024)
+        file = create_file(args.dir, size)
+        try:
+            for strategy in utils.HASH_STRATEGIES:
+                for buffer_size in BUFFER_SIZES:
+                    speed = bench(file, size, strategy, buffer_size, args.rounds)
+                    print(f'{size_mb:>10}  {strategy:10}  {buffer_size // 1024:>10}  {speed:>10.1f}')
+        finally:
+            os.remove(file)
+
+
+if __name__ == '__main__':
+    main()
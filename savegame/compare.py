@@ -0,0 +1,120 @@
+import filecmp
+import hashlib
+import logging
+
+from savegame.utils import FileRef, get_file_hash, get_fingerprint, get_stat
+
+SAMPLE_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_sample_hash(file, size, sample_size=SAMPLE_SIZE):
+    md5_hash = hashlib.md5()
+    with open(file, 'rb') as fd:
+        if size <= 3 * sample_size:
+            md5_hash.update(fd.read())
+        else:
+            for offset in (0, (size - sample_size) // 2, size - sample_size):
+                fd.seek(offset)
+                md5_hash.update(fd.read(sample_size))
+    return md5_hash.hexdigest()
+
+
+class FileComparison:
+    def __init__(self, src_file, dst_file, ref=None, src_stat=None):
+        self.src_file = src_file
+        self.dst_file = dst_file
+        self.src_stat = src_stat or get_stat(src_file)
+        self.dst_stat = get_stat(dst_file)
+        self.file_ref = FileRef.from_ref(ref)
+        self._src_hash = None
+
+    @property
+    def src_hash(self):
+        if self._src_hash is None:
+            self._src_hash = get_file_hash(self.src_file, st=self.src_stat)
+        return self._src_hash
+
+
+class CompareStage:
+    """A stage returns True (equal), False (different) or None (undecided, go to the next stage)."""
+    name = None
+
+    def compare(self, comparison):
+        raise NotImplementedError()
+
+
+class ExistsStage(CompareStage):
+    name = 'exists'
+
+    def compare(self, comparison):
+        return False if comparison.dst_stat is None else None
+
+
+class SizeStage(CompareStage):
+    name = 'size'
+
+    def compare(self, comparison):
+        return False if comparison.src_stat.st_size != comparison.dst_stat.st_size else None
+
+
+class MtimeStage(CompareStage):
+    name = 'mtime'
+
+    def compare(self, comparison):
+        return True if comparison.src_stat.st_mtime_ns == comparison.dst_stat.st_mtime_ns else None
+
+
+class RefStage(CompareStage):
+    """Trusts the hash recorded for the dst file as long as its stat fingerprint is unchanged."""
+    name = 'ref'
+
+    def compare(self, comparison):
+        file_ref = comparison.file_ref
+        if not (file_ref.hash and file_ref.fingerprint and file_ref.fingerprint == get_fingerprint(comparison.dst_stat)):
+            return None
+        return comparison.src_hash == file_ref.hash
+
+
+class SampleStage(CompareStage):
+    name = 'sample'
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+
+    def compare(self, comparison):
+        size = comparison.src_stat.st_size
+        if (get_file_sample_hash(comparison.src_file, size, self.sample_size)
+                != get_file_sample_hash(comparison.dst_file, size, self.sample_size)):
+            return False
+        return True if size <= 3 * self.sample_size else None   # small files are sampled entirely
+
+
+class HashStage(CompareStage):
+    name = 'hash'
+
+    def compare(self, comparison):
+        return comparison.src_hash == get_file_hash(comparison.dst_file, st=comparison.dst_stat)
+
+
+class ContentStage(CompareStage):
+    name = 'content'
+
+    def compare(self, comparison):
+        return filecmp.cmp(comparison.src_file, comparison.dst_file, shallow=False)
+
+
+# only identical mtimes (as set by a copy) are trusted, like filecmp.cmp(shallow=True) does
+COMPARE_PIPELINES = {
+    'hash': [ExistsStage(), SizeStage(), MtimeStage(), RefStage(), SampleStage(), HashStage()],
+    'shallow': [ExistsStage(), SizeStage(), MtimeStage(), SampleStage(), ContentStage()],
+}
+
+
+def compare_files(comparison, method='hash'):
+    for stage in COMPARE_PIPELINES[method]:
+        equal = stage.compare(comparison)
+        if equal is not None:
+            return equal, stage.name
+    raise Exception(f'undecided comparison for {comparison.src_file} with {method=}')
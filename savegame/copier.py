@@ -0,0 +1,250 @@
+from collections import defaultdict
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from savegame.utils import FileRef, HashCache, get_file_hash, get_fingerprint
+
+COPY_CHUNK_SIZE = 1024 * 1024
+DELTA_BLOCK_SIZE = 1024 * 1024
+MAX_ZERO_COPY_SIZE = 1024 * 1024 * 1024
+FICLONE = 0x40049409
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EBADF}
+
+logger = logging.getLogger(__name__)
+
+
+class HashingWriter:
+    """File object wrapper computing the md5 of the written data, and of each block if block_size is set."""
+
+    def __init__(self, fd, block_size=None):
+        self.fd = fd
+        self.md5_hash = hashlib.md5()
+        self.block_size = block_size
+        self.block_hash = hashlib.md5()
+        self.block_written = 0
+        self.block_hashes = []
+
+    def _update_blocks(self, data):
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self.block_size - self.block_written)
+            self.block_hash.update(view[:size])
+            self.block_written += size
+            view = view[size:]
+            if self.block_written == self.block_size:
+                self.block_hashes.append(self.block_hash.hexdigest())
+                self.block_hash, self.block_written = hashlib.md5(), 0
+
+    def write(self, data):
+        self.md5_hash.update(data)
+        if self.block_size:
+            self._update_blocks(data)
+        return self.fd.write(data)
+
+    def hexdigest(self):
+        return self.md5_hash.hexdigest()
+
+    def get_block_hashes(self):
+        if not self.block_size:
+            return None
+        return self.block_hashes + ([self.block_hash.hexdigest()] if self.block_written else [])
+
+
+class CopyBackend:
+    name = None
+    zero_copy = True
+
+    def is_available(self):
+        return True
+
+    def copy(self, src_fd, dst_fd):
+        raise NotImplementedError()
+
+
+class ReflinkBackend(CopyBackend):
+    name = 'reflink'
+
+    def is_available(self):
+        return fcntl is not None and sys.platform == 'linux'
+
+    def copy(self, src_fd, dst_fd):
+        fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+        return os.fstat(src_fd.fileno()).st_size
+
+
+class CopyFileRangeBackend(CopyBackend):
+    name = 'copy_file_range'
+
+    def is_available(self):
+        return hasattr(os, 'copy_file_range')
+
+    def copy(self, src_fd, dst_fd):
+        size = 0
+        while copied := os.copy_file_range(src_fd.fileno(), dst_fd.fileno(), MAX_ZERO_COPY_SIZE):
+            size += copied
+        return size
+
+
+class SendfileBackend(CopyBackend):
+    name = 'sendfile'
+
+    def is_available(self):
+        return sys.platform == 'linux' and hasattr(os, 'sendfile')
+
+    def copy(self, src_fd, dst_fd):
+        size = 0
+        while copied := os.sendfile(dst_fd.fileno(), src_fd.fileno(), None, MAX_ZERO_COPY_SIZE):
+            size += copied
+        return size
+
+
+class BufferedBackend(CopyBackend):
+    name = 'buffered'
+    zero_copy = False
+
+    def __init__(self, chunk_size=COPY_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def copy(self, src_fd, dst_fd):
+        size = 0
+        while chunk := src_fd.read(self.chunk_size):
+            dst_fd.write(chunk)
+            size += len(chunk)
+        return size
+
+
+class CopyEngine:
+    """Picks the cheapest working copy backend per (src device, dst device).
+
+    Zero-copy backends never see the data, so they are only used when the src hash is not needed or already known,
+    except for reflinks which are cheap enough to hash the src afterwards.
+    """
+    _instance = None
+    backends = [ReflinkBackend(), CopyFileRangeBackend(), SendfileBackend()]
+    buffered_backend = BufferedBackend()
+
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls)
+                cls._instance.unsupported = defaultdict(set)
+                cls._instance.stats = defaultdict(lambda: {'files': 0, 'bytes': 0, 'duration': 0})
+        return cls._instance
+
+    def _iterate_backends(self, volume_key, must_hash):
+        for backend in self.backends:
+            if must_hash and backend.name != ReflinkBackend.name:
+                continue
+            if backend.name not in self.unsupported[volume_key] and backend.is_available():
+                yield backend
+        yield self.buffered_backend
+
+    def _copy_data(self, src_fd, dst_fd, volume_key, must_hash, block_size=None):
+        """Returns the HashingWriter which got the data, None if it was not read."""
+        for backend in self._iterate_backends(volume_key, must_hash):
+            start_ts = time.time()
+            writer = HashingWriter(dst_fd, block_size) if must_hash and not backend.zero_copy else None
+            try:
+                size = backend.copy(src_fd, writer or dst_fd)
+            except OSError as e:
+                if not backend.zero_copy or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                logger.info(f'{backend.name} copy is not supported for devices {volume_key}: {e}')
+                with self._lock:
+                    self.unsupported[volume_key].add(backend.name)
+                src_fd.seek(0)
+                dst_fd.seek(0)
+                dst_fd.truncate()
+                continue
+            with self._lock:
+                stats = self.stats[backend.name]
+                stats['files'] += 1
+                stats['bytes'] += size
+                stats['duration'] += time.time() - start_ts
+            return writer
+
+    def copy(self, src_file, dst_file, need_hash=True, block_size=None):
+        """Returns the src stat, the src hash if needed and the block hashes if block_size is set and the data was read."""
+        src_stat = os.stat(src_file)
+        volume_key = (src_stat.st_dev, os.stat(os.path.dirname(os.path.abspath(dst_file))).st_dev)
+        hash = HashCache().get(src_file, src_stat) if need_hash else None
+        with open(src_file, 'rb') as src_fd, open(dst_file, 'wb') as dst_fd:
+            writer = self._copy_data(src_fd, dst_fd, volume_key, must_hash=need_hash and not hash, block_size=block_size)
+        shutil.copystat(src_file, dst_file)
+        if writer:
+            hash = writer.hexdigest()
+        elif need_hash and not hash:   # reflinked
+            hash = get_file_hash(src_file, st=src_stat)
+        return src_stat, hash, writer.get_block_hashes() if writer else None
+
+    def log_stats(self):
+        for name, stats in sorted(self.stats.items()):
+            speed = stats['bytes'] / stats['duration'] / 1024 / 1024 if stats['duration'] else 0
+            logger.info(f'{name} copy: {stats["files"]} files, {stats["bytes"] / 1024 / 1024:.02f} MB, {speed:.02f} MB/s')
+
+
+def cache_file_hash(file, st, hash):
+    try:
+        if get_fingerprint(os.stat(file)) == get_fingerprint(st):   # not modified while being read
+            HashCache().set(file, st, hash)
+    except FileNotFoundError:
+        pass
+
+
+def copy_file(src_file, dst_file, has_src_file=True, need_hash=True, block_size=None):
+    """Copies the file and its metadata like shutil.copy2, hashing the data on the fly if needed.
+
+    Returns a FileRef with the src hash, size and mtime and the dst fingerprint, and with the hashes of the block_size
+    chunks if set and the data was read while copied.
+    """
+    src_stat, hash, chunk_hashes = CopyEngine().copy(src_file, dst_file, need_hash=need_hash, block_size=block_size)
+    dst_stat = os.stat(dst_file)
+    if hash:
+        cache_file_hash(src_file, src_stat, hash)
+        cache_file_hash(dst_file, dst_stat, hash)
+    return FileRef(hash=hash, size=src_stat.st_size, mtime=src_stat.st_mtime, has_src_file=has_src_file,
+                   fingerprint=get_fingerprint(dst_stat), chunk_hashes=chunk_hashes)
+
+
+def delta_copy_file(src_file, dst_file, blocks, block_size=DELTA_BLOCK_SIZE, has_src_file=True):
+    """Rewrites in place only the dst blocks whose hash differs from the known dst block hashes.
+
+    Returns a FileRef like copy_file and the new block hashes.
+    """
+    src_stat = os.stat(src_file)
+    md5_hash = hashlib.md5()
+    new_blocks = []
+    written = 0
+    with open(src_file, 'rb') as src_fd, open(dst_file, 'r+b' if blocks else 'wb') as dst_fd:
+        while chunk := src_fd.read(block_size):
+            md5_hash.update(chunk)
+            block_hash = hashlib.md5(chunk).hexdigest()
+            index = len(new_blocks)
+            if index >= len(blocks) or blocks[index] != block_hash:
+                dst_fd.seek(index * block_size)
+                dst_fd.write(chunk)
+                written += len(chunk)
+            new_blocks.append(block_hash)
+        dst_fd.truncate(src_stat.st_size)
+    shutil.copystat(src_file, dst_file)
+    logger.info(f'delta copied {src_file=} to {dst_file=} ({written / 1024 / 1024:.02f}/{src_stat.st_size / 1024 / 1024:.02f} MB written)')
+    hash = md5_hash.hexdigest()
+    dst_stat = os.stat(dst_file)
+    cache_file_hash(src_file, src_stat, hash)
+    cache_file_hash(dst_file, dst_stat, hash)
+    file_ref = FileRef(hash=hash, size=src_stat.st_size, mtime=src_stat.st_mtime, has_src_file=has_src_file,
+                       fingerprint=get_fingerprint(dst_stat))
+    return file_ref, new_blocks
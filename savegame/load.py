@@ -1,8 +1,10 @@
 import logging
 
+from savegame.copier import CopyEngine
 from savegame.loaders.base import NotFound, get_loader_class
 from savegame.report import LoadReport
 from savegame.save import iterate_save_items
+from savegame.utils import HashCache, HashService
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,9 @@ class LoadHandler:
             except Exception:
                 logger.exception(f'failed to load {loader.id=} {loader.root_dst_path=}')
             report.update(loader.report)
+        HashCache().save()
+        HashService().close()
+        CopyEngine().log_stats()
         report.print_table()
 
 
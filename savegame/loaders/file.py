@@ -1,14 +1,14 @@
 import logging
 import os
 from pathlib import PurePath
-import shutil
 import sys
 import time
 
 from savegame import NAME
+from savegame.copier import copy_file
 from savegame.loaders.base import BaseLoader
-from savegame.utils import (FileRef, UnhandledPath, check_patterns, get_file_hash, get_file_mtime, get_file_size,
-                            iterate_save_refs, validate_path)
+from savegame.utils import (FileRef, HashService, UnhandledPath, check_patterns, get_file_hash, get_file_mtime,
+                            get_file_size, is_tree_hash, iterate_save_refs, validate_path)
 
 HOME_DIR = os.path.expanduser('~')
 SHARED_USERNAMES = {'linux': {'shared'}, 'win32': {'Public'}}.get(sys.platform, set())
@@ -48,7 +48,10 @@ class FileLoader(BaseLoader):
     def _get_src_and_rel_paths(self, save_ref):
         src_rel_paths = set()
         invalid_files = set()
-        for src, file_refs in save_ref.get_files(hostname=self.hostname).items():
+        files = save_ref.get_files(hostname=self.hostname)
+        HashService().warm_cache(os.path.join(save_ref.dst, r) for file_refs in files.values() for r, v in file_refs.items()
+                                 if FileRef.from_ref(v).hash and not is_tree_hash(v))
+        for src, file_refs in files.items():
             try:
                 validate_path(src)
                 is_src_valid = True
@@ -70,7 +73,9 @@ class FileLoader(BaseLoader):
         return src_rel_paths
 
     def _load_from_save_ref(self, save_ref, exclude_rel_paths=None):
-        for src, rel_path in self._get_src_and_rel_paths(save_ref):
+        src_rel_paths = sorted(self._get_src_and_rel_paths(save_ref))
+        HashService().warm_cache(filter(None, (self._get_src_file_for_user(os.path.join(s, r)) for s, r in src_rel_paths)))
+        for src, rel_path in src_rel_paths:
             if exclude_rel_paths and rel_path in exclude_rel_paths:
                 continue
             raw_src_file = os.path.join(src, rel_path)
@@ -96,7 +101,7 @@ class FileLoader(BaseLoader):
                 os.makedirs(os.path.dirname(src_file), exist_ok=True)
                 start_ts = time.time()
                 logger.info(f'copying {dst_file=} to {src_file=} ({get_file_size(dst_file) / 1024 / 1024:.02f} MB)')
-                shutil.copy2(dst_file, src_file)
+                copy_file(dst_file, src_file, need_hash=False)
                 self.report.add(self, save_ref=save_ref, src=src, rel_path=rel_path, code='loaded', start_ts=start_ts,
                                 size=get_file_size(dst_file))
             except Exception:
@@ -46,12 +46,15 @@ def main():
         ALWAYS_UPDATE_REF=False,
         RUN_DELTA=30 * 60,
         MONITOR_RUN_DELTA=3 * 24 * 3600,
+        WATCH_CHANGES=True,
+        SAVE_TIME_BUDGET=None,
         GOOGLE_CREDS=os.path.join(WORK_DIR, 'google_creds.json'),
     )
     if args.cmd == 'save':
         service = Service(
             target=wrap_savegame,
             args=(config,),
+            kwargs={'watch': args.daemon and config.WATCH_CHANGES, 'time_budget': config.SAVE_TIME_BUDGET},
             work_dir=WORK_DIR,
             run_delta=config.RUN_DELTA,
             min_uptime=180,
@@ -46,7 +46,7 @@ class BaseReport:
 
 
 class SaveReport(BaseReport):
-    def add(self, saver, rel_path, code, start_ts=None, size=None):
+    def add(self, saver, rel_path, code, start_ts=None, size=None, stage=None):
         self.data.append({
             'id': saver.id,
             'src': f'{saver.src} ({saver.save_item.src_volume_label})' if saver.save_item.src_volume_label else saver.src,
@@ -55,6 +55,7 @@ class SaveReport(BaseReport):
             'code': code,
             'duration': f'{time.time() - start_ts:.1f}' if start_ts else '',
             'size': f'{size / 1024 / 1024:.1f}' if size else '',
+            'stage': stage or '',   # the compare stage which decided the copy
         })
 
 
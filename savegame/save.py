@@ -1,3 +1,5 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from glob import glob
 import logging
@@ -9,12 +11,19 @@ from svcutils.notifier import get_notifier
 from svcutils.service import RunFile
 
 from savegame import NAME, WORK_DIR
+from savegame.copier import CopyEngine
 from savegame.report import SaveReport
 from savegame.savers.base import get_saver_class, iterate_saver_classes
 from savegame.savers.google_cloud import get_google_cloud
 from savegame.savers.file import FileSaver
-from savegame.utils import (HOSTNAME, FileRef, Metadata, InvalidPath, UnhandledPath, coalesce, get_file_mtime,
-                            get_file_size, iterate_save_refs, normalize_path, list_label_mountpoints, validate_path)
+from savegame.utils import (HOSTNAME, BlockRef, FileRef, HashCache, HashService, Metadata, InvalidPath, SaveRefError,
+                            ScanCache, UnhandledPath, VolumeLimiter, coalesce, get_stat, is_tree_hash, iterate_save_refs, normalize_path,
+                            list_label_mountpoints, parse_tree_hash, validate_path)
+from savegame.watcher import ChangeJournal
+
+CHECK_FILE_TIME_BUDGET = 10
+SAVER_WORKERS = 4
+SAVERS_PER_VOLUME = 2
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +33,7 @@ class SaveItem:
                  run_delta=None, purge_delta=None, enable_purge=True, loadable=True, platform=None,
                  hostname=None, src_volume_label=None, dst_volume_label=None, trigger_volume_labels=None,
                  retry_delta=None, file_compare_method=None, due_warning_delta=7 * 24 * 3600,
-                 next_warning_delta=24 * 3600):
+                 next_warning_delta=24 * 3600, delta_size_threshold=None, src_workers=None, dst_workers=None):
         self.config = config
         self.src_volume_label = src_volume_label
         self.dst_volume_label = dst_volume_label
@@ -44,6 +53,9 @@ class SaveItem:
         self.file_compare_method = file_compare_method
         self.due_warning_delta = due_warning_delta
         self.next_warning_delta = next_warning_delta
+        self.delta_size_threshold = delta_size_threshold
+        self.src_workers = src_workers
+        self.dst_workers = dst_workers
         self.notifier = get_notifier(app_name=NAME, telegram_bot_token=self.config.TELEGRAM_BOT_TOKEN, telegram_chat_id=self.config.TELEGRAM_CHAT_ID)
 
     def _get_src_paths(self, src_paths):
@@ -109,7 +121,11 @@ class SaveItem:
             return
         is_ready = not self.trigger_volume_labels or self._check_trigger_volume_labels()
         for src_and_patterns in self._generate_src_and_patterns():
-            saver = self.saver_cls(self.config, self, *src_and_patterns)
+            try:
+                saver = self.saver_cls(self.config, self, *src_and_patterns)
+            except SaveRefError as e:   # retried on the next run
+                logger.error(e)
+                continue
             if not is_ready:
                 self._check_due(saver)
                 continue
@@ -134,29 +150,91 @@ def iterate_save_items(config, log_unhandled=False, log_invalid=True):
 
 
 class SaveHandler:
-    def __init__(self, config, force=False):
+    """Runs the savers in a thread pool, with a limited number of savers per src and dst volume.
+
+    Network bound savers run in a separate pool, so they do not hold the disk savers workers while waiting on remote APIs.
+    Savers sharing a dst run one after another. The most overdue and then the cheapest savers run first,
+    and savers not expected to complete within the time budget are deferred to the next run.
+    """
+    workers = SAVER_WORKERS
+    savers_per_volume = SAVERS_PER_VOLUME
+
+    def __init__(self, config, force=False, watch=False, time_budget=None):
         self.config = config
         self.force = force
+        self.watch = watch
+        self.time_budget = time_budget
+        self.deadline = None
         self.notifier = get_notifier(app_name=NAME, telegram_bot_token=self.config.TELEGRAM_BOT_TOKEN, telegram_chat_id=self.config.TELEGRAM_CHAT_ID)
 
     def _generate_savers(self):
         for si in iterate_save_items(self.config):
             yield from si.generate_savers()
 
+    def _get_semaphores(self, saver):
+        paths = [('saver_src', saver.src)] if os.path.isabs(saver.src) else []   # some savers have no src path
+        paths.append(('saver_dst', saver.dst))
+        return [VolumeLimiter().get(role, path, self.savers_per_volume) for role, path in paths]
+
+    def _run_saver(self, saver):
+        if self.watch:
+            saver.change_journal = ChangeJournal()
+        semaphores = self._get_semaphores(saver)
+        for semaphore in semaphores:   # always acquired in the same order
+            semaphore.acquire()
+        try:
+            saver.run()
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def _get_priority(self, saver):
+        return -int(saver.get_overdue_ratio()), saver.get_estimated_duration()
+
+    def _must_defer(self, saver):
+        return self.deadline is not None and time.time() + saver.get_estimated_duration() > self.deadline
+
+    def _run_savers(self, savers):
+        failed_savers, deferred_savers = [], []
+        for saver in savers:
+            if self._must_defer(saver):
+                saver.report.add(saver, rel_path='', code='deferred')
+                deferred_savers.append(saver)
+                continue
+            try:
+                self._run_saver(saver)
+            except Exception:
+                logger.exception(f'failed to save {saver.src}')
+                failed_savers.append(saver)
+        return failed_savers, deferred_savers
+
     def run(self):
         logger.info('running save handler')
         start_ts = time.time()
+        self.deadline = start_ts + self.time_budget if self.time_budget else None
         savers = list(self._generate_savers())
         runnable_savers = [s for s in savers if self.force or s.must_run()]
+        savers_by_dst = defaultdict(list)
+        for saver in runnable_savers:   # keeping the config order for a dst
+            savers_by_dst[saver.dst].append(saver)
+        saver_groups = sorted(savers_by_dst.values(), key=lambda x: min(map(self._get_priority, x)))
+        disk_groups, network_groups = [], []
+        for group in saver_groups:
+            (network_groups if all(s.network_bound for s in group) else disk_groups).append(group)
+        failed_savers, deferred_savers = [], []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                ThreadPoolExecutor(max_workers=max(len(network_groups), 1)) as network_executor:
+            network_results = network_executor.map(self._run_savers, network_groups)
+            results = list(executor.map(self._run_savers, disk_groups)) + list(network_results)
+        for failed, deferred in results:
+            failed_savers.extend(failed)
+            deferred_savers.extend(deferred)
+        if deferred_savers:
+            logger.info(f'deferred {len(deferred_savers)} saves to the next run: '
+                        f'{", ".join(sorted(s.src for s in deferred_savers))}')
         report = SaveReport()
-        failed_savers = []
         volume_labels = set()
         for saver in runnable_savers:
-            try:
-                saver.run()
-            except Exception:
-                logger.exception(f'failed to save {saver.src}')
-                failed_savers.append(saver)
             report.update(saver.report)
             for attr in ('src_volume_label', 'dst_volume_label'):
                 volume_label = getattr(saver.save_item, attr)
@@ -165,6 +243,9 @@ class SaveHandler:
         if failed_savers:
             self.notifier.send(title='failed savers', body=', '.join(sorted(r.src for r in failed_savers)), replace_key='failed-savers')
         Metadata().save()
+        HashCache().save()
+        ScanCache().save()
+        CopyEngine().log_stats()
 
         report.print_table(exclude_codes=None if self.force else {'purgeable'})
         failed_files = [r for r in report.data if r['code'] == 'failed']
@@ -172,7 +253,7 @@ class SaveHandler:
             self.notifier.send(title='failed files', body=f'{len(failed_files)} failed files', replace_key='failed-files')
         if volume_labels:
             self.notifier.send(title='saved volumes', body=', '.join(sorted(volume_labels)), replace_key='saved-volumes')
-        logger.info(f'completed {len(runnable_savers)}/{len(savers)} saves in {time.time() - start_ts:.02f}s')
+        logger.info(f'completed {len(runnable_savers) - len(deferred_savers)}/{len(savers)} saves in {time.time() - start_ts:.02f}s')
 
 
 class SaveMonitor:
@@ -191,31 +272,44 @@ class SaveMonitor:
         for root_dst_path in root_dst_paths:
             yield from iterate_save_refs(root_dst_path)
 
-    def _get_size(self, save_ref, files):
-        try:
-            sizes = [get_file_size(os.path.join(save_ref.dst, normalize_path(r)), default=0) for r in files.keys()]
-            return float(f'{sum(sizes) / 1024 / 1024:.02f}')
-        except Exception:
-            logger.exception(f'failed to get {save_ref.dst} size')
-            return -1
-
-    def _check_file(self, hostname, save_ref, src, rel_path, ref):
+    def _check_file(self, hostname, save_ref, src, rel_path, ref, dst_stat=None):
         if not isinstance(ref, str):
             return
         rel_path = normalize_path(rel_path)
         dst_file = os.path.join(save_ref.dst, rel_path)
-        if not os.path.exists(dst_file):
+        dst_stat = dst_stat or get_stat(dst_file)
+        if not dst_stat:
             return f'missing dst file {dst_file}'
         file_ref = FileRef.from_ref(ref)
-        if not file_ref.check_file(dst_file):
+        chunk_hashes = None
+        if is_tree_hash(file_ref.hash):
+            chunk_hashes = BlockRef(save_ref.dst).get_blocks(rel_path, parse_tree_hash(file_ref.hash)[0])
+        if not file_ref.check_file(dst_file, chunk_hashes=chunk_hashes, time_budget=CHECK_FILE_TIME_BUDGET, st=dst_stat):
             return f'conflicting dst file {dst_file}'
         if file_ref.has_src_file and hostname == HOSTNAME:
             src_file = os.path.join(src, rel_path)
-            if not os.path.exists(src_file):
+            src_stat = get_stat(src_file)
+            if not src_stat:
                 return f'missing src file {src_file}'
-            if not file_ref.check_file(src_file):
+            if not file_ref.check_file(src_file, chunk_hashes=chunk_hashes, time_budget=CHECK_FILE_TIME_BUDGET, st=src_stat):
                 return f'conflicting src file {src_file}'
 
+    def _hash_files(self, hostname, save_ref, files):
+        """Hashes the files to check with the hash service, so the checks hit the hash cache."""
+        paths = []
+        for src, file_refs in files.items():
+            for rel_path, ref in file_refs.items():
+                if not isinstance(ref, str):
+                    continue
+                file_ref = FileRef.from_ref(ref)
+                if not file_ref.hash or is_tree_hash(file_ref.hash):
+                    continue
+                rel_path = normalize_path(rel_path)
+                paths.append(os.path.join(save_ref.dst, rel_path))
+                if file_ref.has_src_file and hostname == HOSTNAME:
+                    paths.append(os.path.join(src, rel_path))
+        HashService().warm_cache(paths)
+
     def _generate_savers(self):
         for si in iterate_save_items(self.config):
             yield from si.generate_savers()
@@ -230,15 +324,19 @@ class SaveMonitor:
     def _generate_report(self):
         saves = []
         for save_ref in self._iterate_save_refs():
-            for hostname, files in save_ref.files.items():
+            for hostname in save_ref.get_hostnames():
+                files = save_ref.get_files(hostname=hostname)
+                self._hash_files(hostname, save_ref, files)
                 mtimes = []
                 desynced = []
                 for src, file_refs in files.items():
+                    sizes = []
                     for rel_path, ref in file_refs.items():
-                        dst_file = os.path.join(save_ref.dst, normalize_path(rel_path))
-                        if os.path.exists(dst_file):
-                            mtimes.append(get_file_mtime(dst_file))
-                        error = self._check_file(hostname, save_ref, src, rel_path, ref)
+                        dst_stat = get_stat(os.path.join(save_ref.dst, normalize_path(rel_path)))
+                        if dst_stat:
+                            mtimes.append(dst_stat.st_mtime)
+                            sizes.append(dst_stat.st_size)
+                        error = self._check_file(hostname, save_ref, src, rel_path, ref, dst_stat=dst_stat)
                         if error:
                             desynced.append(rel_path)
                             logger.error(f'inconsistency in {save_ref.dst}: {error}')
@@ -246,7 +344,7 @@ class SaveMonitor:
                         'hostname': hostname,
                         'src': f'{src} ({list(file_refs.keys())[0]})' if len(file_refs) == 1 else src,
                         'modified': max(mtimes) if mtimes else 0,
-                        'size_MB': self._get_size(save_ref, file_refs),
+                        'size_MB': float(f'{sum(sizes) / 1024 / 1024:.02f}'),
                         'files': len(file_refs),
                         'desynced': len(desynced),
                     })
@@ -267,12 +365,14 @@ class SaveMonitor:
         logger.info('running save monitor')
         start_ts = time.time()
         report = self._generate_report()
+        HashCache().save()
         self.notifier.send(title='status', body=report['message'], replace_key='status')
         self.run_file.touch()
         logger.info(f'completed save monitor in {time.time() - start_ts:.02f}s')
 
     def get_status(self, order_by='hostname,modified'):
         report = self._generate_report()
+        HashCache().save()
         if report['saves']:
             headers = {k: k for k in report['saves'][0].keys()}
             order_by_cols = order_by.split(',') + ['src']
@@ -285,13 +385,13 @@ class SaveMonitor:
         print(report['message'])
 
 
-def savegame(config, force=False):
+def savegame(config, force=False, watch=False, time_budget=None):
     def notify(title, body, replace_key):
         notifier = get_notifier(app_name=NAME, telegram_bot_token=config.TELEGRAM_BOT_TOKEN, telegram_chat_id=config.TELEGRAM_CHAT_ID)
         notifier.send(title=title, body=body, replace_key=replace_key)
 
     try:
-        SaveHandler(config, force=force).run()
+        SaveHandler(config, force=force, watch=watch, time_budget=time_budget).run()
     except Exception as e:
         logger.exception('failed to save')
         notify('error', str(e), 'save-error')
@@ -300,10 +400,12 @@ def savegame(config, force=False):
     except Exception as e:
         logger.exception('failed to monitor')
         notify('error', str(e), 'status-error')
+    HashService().close()
 
 
 def status(config, **kwargs):
     SaveMonitor(config).get_status(**kwargs)
+    HashService().close()
 
 
 def google_oauth(config, **kwargs):
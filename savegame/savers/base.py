@@ -1,18 +1,22 @@
-import filecmp
+from collections import Counter, defaultdict
 import importlib
 import inspect
 import json
 import logging
 import os
 import re
+import threading
 import time
 
 from svcutils.notifier import get_notifier
 
 from savegame import NAME
+from savegame.compare import FileComparison, compare_files
+from savegame.copier import DELTA_BLOCK_SIZE, copy_file, delta_copy_file
 from savegame.report import SaveReport
-from savegame.utils import (HOSTNAME, MTIME_DRIFT_TOLERANCE, REF_FILENAME, FileRef, Metadata, NotFound, SaveRef,
-                            coalesce, get_file_mtime, get_file_hash, get_hash, remove_path, validate_path)
+from savegame.utils import (HOSTNAME, MTIME_DRIFT_TOLERANCE, REF_FILENAME, BlockRef, Checkpoint, FileRef, Metadata,
+                            NotFound, PatternMatcher, SaveRef, SaveRefIndex, ScanCache, coalesce, get_fingerprint,
+                            get_hash, get_stat, is_ref_file, parse_tree_hash, remove_path, validate_path)
 
 logger = logging.getLogger(__name__)
 
@@ -27,21 +31,17 @@ def path_to_dirname(x):
     return x.strip('-')
 
 
-def walk_paths(path):
-    for root, dirs, files in os.walk(path, topdown=False):
-        for item in files + dirs:
-            yield os.path.join(root, item)
-
-
 class BaseSaver:
     id = None
     hostname = HOSTNAME
     dst_type = 'local'
     in_place = False
     enable_purge = True
+    network_bound = False
     purge_delta = 15 * 24 * 3600
     retry_delta = 2 * 3600
     file_compare_method = 'hash'
+    delta_size_threshold = None
 
     def __init__(self, config, save_item, src, include, exclude):
         self.config = config
@@ -49,11 +49,17 @@ class BaseSaver:
         self.src = src
         self.include = include
         self.exclude = exclude
+        self.pattern_matcher = PatternMatcher(include, exclude)
         self.dst = self._get_dst()
         self.save_ref = SaveRef(self.dst)
         self.key = self._get_key()
+        self.checkpoint = Checkpoint(self.key)
         self.meta = Metadata()
         self.report = SaveReport()
+        self.compare_stages = Counter()
+        self.lock = threading.Lock()
+        self.change_journal = None
+        self.confirmed_files = None
         self.start_ts = None
         self.end_ts = None
         self.success = None
@@ -118,58 +124,150 @@ class BaseSaver:
     def must_run(self):
         return time.time() > self.meta.get(self.key).get('next_ts', 0)
 
+    def get_overdue_ratio(self):
+        """Returns the number of run deltas elapsed since the saver is due."""
+        return (time.time() - self.meta.get(self.key).get('next_ts', 0)) / max(self.save_item.run_delta, 1)
+
+    def get_estimated_duration(self):
+        meta = self.meta.get(self.key)
+        return (meta.get('end_ts') or 0) - (meta.get('start_ts') or 0)
+
     def reset_files(self, src):
         return self.save_ref.reset_files(src, hostname=self.hostname)
 
     def set_file(self, src, rel_path, ref):
         self.save_ref.set_file(src, rel_path, ref, hostname=self.hostname)
 
-    def must_copy_file(self, src_file, dst_file, default_ref):
-        src_mtime = get_file_mtime(src_file)
-        dst_mtime = get_file_mtime(dst_file)
+    def _get_file_compare_method(self):
+        return coalesce(self.save_item.file_compare_method, self.file_compare_method)
 
-        if coalesce(self.save_item.file_compare_method, self.file_compare_method) == 'hash':
-            src_hash = get_file_hash(src_file)
-            equal = src_hash == get_file_hash(dst_file)
-            new_ref = FileRef(hash=src_hash).ref
-        else:
-            equal = filecmp.cmp(src_file, dst_file, shallow=True) if os.path.exists(dst_file) else False
-            new_ref = FileRef(size=os.path.getsize(src_file), mtime=src_mtime).ref
+    def _to_ref(self, file_ref):
+        if self._get_file_compare_method() == 'hash':
+            return FileRef(hash=file_ref.hash, fingerprint=file_ref.fingerprint).ref
+        return FileRef(size=file_ref.size, mtime=file_ref.mtime, fingerprint=file_ref.fingerprint).ref
+
+    def count_compare_stage(self, stage):
+        with self.lock:
+            self.compare_stages[stage] += 1
+
+    def must_copy_file(self, src_file, dst_file, default_ref, report=None, src_stat=None):
+        """Returns (must_copy, ref, the name of the compare stage which decided)."""
+        comparison = FileComparison(src_file, dst_file, ref=default_ref, src_stat=src_stat)
+        src_mtime = comparison.src_stat.st_mtime
+        dst_mtime = comparison.dst_stat.st_mtime if comparison.dst_stat else None
+
+        method = self._get_file_compare_method()
+        equal, stage = compare_files(comparison, method)
+        self.count_compare_stage(stage)
         must_copy = not equal
         if equal:
-            default_ref = new_ref
+            default_ref = self._to_ref(FileRef(
+                hash=comparison.src_hash if method == 'hash' else None,
+                size=comparison.src_stat.st_size,
+                mtime=src_mtime,
+                fingerprint=get_fingerprint(comparison.dst_stat),
+            ))
 
         if must_copy and src_mtime and dst_mtime and src_mtime < dst_mtime - MTIME_DRIFT_TOLERANCE:   # never overwrite newer files, useful after a vm restore
             logger.warning(f'{dst_file=} is newer than {src_file=}')
-            self.report.add(self, rel_path=os.path.relpath(src_file, self.src), code='failed_dst_newer')
+            (report or self.report).add(self, rel_path=os.path.relpath(src_file, self.src), code='failed_dst_newer',
+                                        stage=stage)
             must_copy = False
 
-        return must_copy, new_ref, default_ref
-
-    def _must_purge_dst_path(self, path, dst_files, cutoff_ts):
-        if os.path.isfile(path):
-            if path in dst_files:
-                return False
-            name = os.path.basename(path)
-            if name == REF_FILENAME:
-                return False
-            if not name.startswith(REF_FILENAME) and get_file_mtime(path) > cutoff_ts:
-                self.report.add(self, rel_path=os.path.relpath(path, self.dst), code='purgeable')
-                return False
-        elif os.listdir(path):
+        return must_copy, default_ref, stage
+
+    def _get_dst_blocks(self, dst_file):
+        """Returns the block hashes of the dst file, empty if it is missing or changed since they were recorded."""
+        dst_stat = get_stat(dst_file)
+        if not dst_stat:
+            return []
+        return BlockRef(self.dst).get_blocks(os.path.relpath(dst_file, self.dst), DELTA_BLOCK_SIZE, dst_stat=dst_stat)
+
+    def _copy_large_file(self, src_file, dst_file, need_hash):
+        """Rewrites only the changed blocks if the dst blocks are known, else copies with the copy engine."""
+        rel_path = os.path.relpath(dst_file, self.dst)
+        if blocks := self._get_dst_blocks(dst_file):
+            file_ref, blocks = delta_copy_file(src_file, dst_file, blocks, DELTA_BLOCK_SIZE)
+        else:
+            file_ref = copy_file(src_file, dst_file, need_hash=need_hash, block_size=DELTA_BLOCK_SIZE)
+            blocks = file_ref.chunk_hashes   # None if reflinked or copied without reading the data
+        if blocks:
+            BlockRef(self.dst).set_blocks(rel_path, file_ref.fingerprint, DELTA_BLOCK_SIZE, blocks)
+        return file_ref
+
+    def get_dst_file_ref(self, dst_file, hash=None):
+        file_ref = FileRef.from_file(dst_file, has_src_file=False, hash=hash)
+        if file_ref.chunk_hashes:
+            BlockRef(self.dst).set_blocks(os.path.relpath(dst_file, self.dst), get_fingerprint(os.stat(dst_file)),
+                                          parse_tree_hash(file_ref.hash)[0], file_ref.chunk_hashes)
+        return file_ref
+
+    def copy_file(self, src_file, dst_file):
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        need_hash = self._get_file_compare_method() == 'hash'
+        delta_size_threshold = coalesce(self.save_item.delta_size_threshold, self.delta_size_threshold)
+        if delta_size_threshold and os.path.getsize(src_file) >= delta_size_threshold:
+            return self._to_ref(self._copy_large_file(src_file, dst_file, need_hash))
+        return self._to_ref(copy_file(src_file, dst_file, need_hash=need_hash))
+
+    def _list_purgeable_dir(self, path):
+        """Returns the file entries and subdir paths with a single scandir, symlinks being listed as files."""
+        file_entries, dir_paths = [], []
+        with os.scandir(path) as scandir_it:
+            for entry in scandir_it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dir_paths.append(entry.path)
+                else:
+                    file_entries.append(entry)
+        return file_entries, dir_paths
+
+    def _purge_dir(self, path, dst_names, cutoff_ts, remaining_files):
+        """Purges the dir bottom-up, returns True if it is left empty."""
+        try:
+            file_entries, dir_paths = self._list_purgeable_dir(path)
+        except OSError:
             return False
-        return True
+        empty_dirs = [d for d in dir_paths if self._purge_dir(d, dst_names, cutoff_ts, remaining_files)]
+        purge_names = {e.name for e in file_entries} - dst_names.get(path, set())
+        purge_files = []
+        for entry in file_entries:
+            if entry.name not in purge_names or is_ref_file(entry.name):
+                remaining_files.add(entry.path)
+                continue
+            try:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            if not entry.name.startswith(REF_FILENAME) and mtime > cutoff_ts:
+                self.report.add(self, rel_path=os.path.relpath(entry.path, self.dst), code='purgeable')
+                remaining_files.add(entry.path)
+            else:
+                purge_files.append(entry.path)
+        for file, remove in [(f, os.remove) for f in purge_files] + [(d, os.rmdir) for d in empty_dirs]:
+            try:
+                remove(file)
+            except FileNotFoundError:
+                pass
+            self.report.add(self, rel_path=os.path.relpath(file, self.dst), code='purged')
+        return len(purge_files) + len(empty_dirs) == len(file_entries) + len(dir_paths)
 
     def _purge_dst(self):
+        """Returns the remaining dst files, so the save ref can check its files without stat'ing them again."""
         dst_files = self.save_ref.get_dst_files(hostname=self.hostname)
         if not dst_files and not self.in_place:
             remove_path(self.dst)
-            return
+            return set()
+        dst_names = defaultdict(set)
+        for dst_file in dst_files:
+            dst_names[os.path.dirname(dst_file)].add(os.path.basename(dst_file))
         cufoff_ts = time.time() - coalesce(self.save_item.purge_delta, self.purge_delta)
-        for path in walk_paths(self.dst):
-            if self._must_purge_dst_path(path, dst_files, cufoff_ts):
-                remove_path(path)
-                self.report.add(self, rel_path=os.path.relpath(path, self.dst), code='purged')
+        remaining_files = set()
+        self._purge_dir(self.dst, dst_names, cufoff_ts, remaining_files)
+        return remaining_files
 
     def do_run(self):
         raise NotImplementedError()
@@ -179,16 +277,26 @@ class BaseSaver:
         logger.info(f'running {self.id=} {self.src=} {self.dst=}')
         try:
             self.do_run()
+            if self.compare_stages:
+                logger.debug(f'compared {self.compare_stages.total()} files for {self.src=}: {dict(self.compare_stages)}')
+            dst_files = None
             if self.enable_purge and self.save_item.enable_purge:
-                self._purge_dst()
+                dst_files = self._purge_dst()
             if os.path.exists(self.save_ref.dst):
-                self.save_ref.save(hostname=self.hostname, force=self.config.ALWAYS_UPDATE_REF)
+                self.save_ref.save(hostname=self.hostname, force=self.config.ALWAYS_UPDATE_REF, dst_files=dst_files)
+                SaveRefIndex(self.save_item.root_dst_path).set(self.dst)
+                if self.dst in BlockRef._instances:
+                    BlockRef(self.dst).save()
+                self.checkpoint.remove()
+                if self.confirmed_files is not None:
+                    ScanCache().set_files(self.key, self.confirmed_files)
             self.success = True
         except Skipped as e:
             logger.info(f'skipped {self.id=} {self.src=} {self.dst=}: {e}')
             self.success = True
         except Exception as e:
             logger.exception(f'failed to save {self.src=}')
+            self.checkpoint.flush()
             self.notifier.send(title='error', body=f'failed to save {self.src}: {e}')
             self.success = False
         self.end_ts = time.time()
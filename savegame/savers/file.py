@@ -1,13 +1,21 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
-import shutil
+import stat
 import time
 
+from savegame.report import SaveReport
 from savegame.savers.base import BaseSaver
-from savegame.utils import REF_FILENAME, check_patterns, get_file_size, walk_files
+from savegame.utils import (FileEntry, FileRef, ScanCache, VolumeLimiter, coalesce, get_fingerprint, get_stat,
+                            is_racy, is_ref_file)
 
 LOG_LIST_DURATION_THRESHOLD = 30
 LOG_FILE_SIZE_THRESHOLD = 10 * 1024 * 1024
+DELTA_SIZE_THRESHOLD = 64 * 1024 * 1024
+SRC_WORKERS = 4
+DST_WORKERS = 4
+PENDING_FILES_PER_WORKER = 4
 
 logger = logging.getLogger(__name__)
 
@@ -17,50 +25,159 @@ class FileSaver(BaseSaver):
     in_place = False
     enable_purge = True
     file_compare_method = 'hash'
+    delta_size_threshold = DELTA_SIZE_THRESHOLD
+    src_workers = SRC_WORKERS
+    dst_workers = DST_WORKERS   # set to 1 for spinning disks
 
     def _is_file_valid(self, file):
-        return os.path.basename(file) != REF_FILENAME and check_patterns(file, self.include, self.exclude)
+        return not is_ref_file(os.path.basename(file)) and self.pattern_matcher.match(file)
 
     def _get_src_and_files(self):
         start_ts = time.time()
         if os.path.isfile(self.src):
             src = os.path.dirname(self.src)
-            raw_files = [self.src]
+            entries = [FileEntry(self.src, os.stat(self.src))]
         else:
             src = self.src
-            raw_files = list(walk_files(self.src))
-        files = {f for f in raw_files if self._is_file_valid(f)}
+            entries = ScanCache().walk(self.src, prune=self.pattern_matcher.must_prune)
+        files = {e.path: e.stat for e in entries if self._is_file_valid(e.path)}
         duration = time.time() - start_ts
         if duration > LOG_LIST_DURATION_THRESHOLD:
             logger.warning(f'listed {len(files)} files for {self.src=} {self.include=} {self.exclude=} in {duration:.1f}s')
         return src, files
 
+    def _get_dirty_files(self, src, file_refs, dirty_paths):
+        """Lists the files below the dirty paths and the rel paths of the other files with a ref."""
+        files = {}
+        for path in dirty_paths:
+            st = get_stat(path)
+            if not st:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                entries = ScanCache().walk(path, prune=self.pattern_matcher.must_prune)
+            else:
+                entries = [FileEntry(path, st)]
+            files.update({e.path: e.stat for e in entries if self._is_file_valid(e.path)})
+
+        def is_dirty(path):
+            while len(path) >= len(src):
+                if path in dirty_paths:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        clean_rel_paths = [r for r in file_refs if not is_dirty(os.path.join(src, r))]
+        return files, clean_rel_paths
+
     def _check_dst_volume(self):
         if self.save_item.dst_volume_path and not os.path.exists(self.save_item.dst_volume_path):
             raise Exception(f'volume {self.save_item.dst_volume_path} does not exist')
 
-    def do_run(self):
-        src, src_files = self._get_src_and_files()
-        file_refs = self.reset_files(src)
-        for src_file in sorted(src_files):
+    def _check_dst_fingerprint(self, ref, dst_file):
+        """Returns True if the dst file was not modified since the ref was recorded."""
+        dst_fingerprint = get_fingerprint(get_stat(dst_file))
+        return bool(dst_fingerprint) and FileRef.from_ref(ref).fingerprint == dst_fingerprint
+
+    def _get_checkpoint_ref(self, checkpoint_file, src_stat, dst_file):
+        """Returns the ref confirmed by an interrupted run if neither the src nor the dst file changed since."""
+        if not checkpoint_file or checkpoint_file[0] != get_fingerprint(src_stat):
+            return None
+        return checkpoint_file[1] if self._check_dst_fingerprint(checkpoint_file[1], dst_file) else None
+
+    def _save_file(self, src_file, src_stat, dst_file, rel_path, default_ref, semaphores):
+        report = SaveReport()
+        ref, stage = default_ref, None
+        with semaphores[0], semaphores[1]:
             self._check_dst_volume()
-            rel_path = os.path.relpath(src_file, src)
-            dst_file = os.path.join(self.dst, rel_path)
-            must_copy, new_ref, ref = self.must_copy_file(src_file, dst_file, file_refs.get(rel_path))
             try:
+                must_copy, ref, stage = self.must_copy_file(src_file, dst_file, default_ref, report=report,
+                                                            src_stat=src_stat)
                 if must_copy:
-                    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-                    file_size = get_file_size(src_file)
+                    file_size = src_stat.st_size
                     if file_size > LOG_FILE_SIZE_THRESHOLD:
                         logger.info(f'copying {src_file=} to {dst_file=} ({file_size / 1024 / 1024:.02f} MB)')
                     start_ts = time.time()
-                    shutil.copy2(src_file, dst_file)
-                    ref = new_ref
-                    self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=file_size)
+                    ref = self.copy_file(src_file, dst_file)
+                    report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=file_size, stage=stage)
             except Exception:
                 logger.exception(f'failed to copy {src_file=} to {dst_file=}')
-                self.report.add(self, rel_path=rel_path, code='failed')
-            self.set_file(src, rel_path, ref)
+                report.add(self, rel_path=rel_path, code='failed', stage=stage)
+        return ref, report, all(r['code'] == 'saved' for r in report.data)
+
+    def do_run(self):
+        dirty_paths = None
+        if self.change_journal and os.path.isdir(self.src):
+            dirty_paths = self.change_journal.get_dirty_paths(self.key, self.src, prune=self.pattern_matcher.must_prune)
+        try:
+            self._save_files(dirty_paths)
+        except BaseException:
+            if self.change_journal:
+                self.change_journal.invalidate(self.key)
+            raise
+
+    def _apply_result(self, src, rel_path, src_stat, ref, future, confirmed_files):
+        confirmed = True
+        if future is not None:
+            ref, report, confirmed = future.result()
+            self.report.update(report)
+            if confirmed and not is_racy(src_stat):
+                self.checkpoint.add(rel_path, get_fingerprint(src_stat), ref)
+        self.set_file(src, rel_path, ref)
+        if confirmed and not is_racy(src_stat):
+            confirmed_files[rel_path] = list(get_fingerprint(src_stat))
+
+    def _save_files(self, dirty_paths=None):
+        if dirty_paths is None:
+            src, src_files = self._get_src_and_files()
+            file_refs = self.reset_files(src)
+            clean_rel_paths = []
+        else:
+            src = self.src
+            file_refs = self.reset_files(src)
+            src_files, clean_rel_paths = self._get_dirty_files(src, file_refs, dirty_paths)
+            logger.debug(f'{len(dirty_paths)} dirty paths for {self.src=}: {len(src_files)} files to check')
+        src_workers = coalesce(self.save_item.src_workers, self.src_workers)
+        dst_workers = coalesce(self.save_item.dst_workers, self.dst_workers)
+        semaphores = (VolumeLimiter().get('src', src, src_workers),
+                      VolumeLimiter().get('dst', self.save_item.root_dst_path, dst_workers))
+        confirmed_files = ScanCache().get_files(self.key)
+        new_confirmed_files = {}
+        for rel_path in clean_rel_paths:
+            if self._check_dst_fingerprint(file_refs[rel_path], os.path.join(self.dst, rel_path)):
+                self.set_file(src, rel_path, file_refs[rel_path])
+                if rel_path in confirmed_files:
+                    new_confirmed_files[rel_path] = confirmed_files[rel_path]
+            elif src_stat := get_stat(os.path.join(src, rel_path)):   # dst modified or removed outside of savegame
+                src_files[os.path.join(src, rel_path)] = src_stat
+        checkpoint_files = self.checkpoint.load()
+        workers = max(src_workers, dst_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()   # bounded, results are applied in the sorted files order
+            try:
+                for src_file in sorted(src_files):
+                    src_stat = src_files[src_file]
+                    rel_path = os.path.relpath(src_file, src)
+                    dst_file = os.path.join(self.dst, rel_path)
+                    # files unchanged since their last save keep their ref without being compared
+                    if (rel_path in file_refs and confirmed_files.get(rel_path) == list(get_fingerprint(src_stat))
+                            and self._check_dst_fingerprint(file_refs[rel_path], dst_file)):
+                        self.count_compare_stage('scan_cache')
+                        pending.append((rel_path, src_stat, file_refs[rel_path], None))
+                    elif ref := self._get_checkpoint_ref(checkpoint_files.get(rel_path), src_stat, dst_file):
+                        self.count_compare_stage('checkpoint')
+                        pending.append((rel_path, src_stat, ref, None))
+                    else:
+                        pending.append((rel_path, src_stat, None, executor.submit(
+                            self._save_file, src_file, src_stat, dst_file, rel_path, file_refs.get(rel_path), semaphores)))
+                    while len(pending) > workers * PENDING_FILES_PER_WORKER:
+                        self._apply_result(src, *pending.popleft(), new_confirmed_files)
+                while pending:
+                    self._apply_result(src, *pending.popleft(), new_confirmed_files)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                self.checkpoint.flush()
+                raise
+        self.confirmed_files = new_confirmed_files   # committed once the save ref is saved
 
 
 class FileMirrorSaver(FileSaver):
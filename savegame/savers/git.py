@@ -3,7 +3,6 @@ import hashlib
 import logging
 import os
 import subprocess
-import shutil
 import time
 
 from savegame.savers.base import BaseSaver
@@ -86,7 +85,7 @@ class GitSaver(BaseSaver):
                     git.create_bundle(tmp_file)
                     remove_path(dst_file)
                     os.rename(tmp_file, dst_file)
-                    file_ref = FileRef.from_file(dst_file, has_src_file=False)
+                    file_ref = self.get_dst_file_ref(dst_file)
                     self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=get_file_size(dst_file))
             except Exception:
                 logger.exception(f'failed to create bundle for {src_path}')
@@ -96,11 +95,10 @@ class GitSaver(BaseSaver):
             for src_file in sorted(git.list_non_committed_files()):
                 rel_path = os.path.relpath(src_file, self.src)
                 dst_file = os.path.join(self.dst, rel_path)
-                must_copy, new_ref, ref = self.must_copy_file(src_file, dst_file, file_refs.get(rel_path))
+                must_copy, ref, stage = self.must_copy_file(src_file, dst_file, file_refs.get(rel_path))
                 if must_copy:
                     start_ts = time.time()
-                    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-                    shutil.copy2(src_file, dst_file)
-                    self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=get_file_size(src_file))
-                    ref = new_ref
+                    ref = self.copy_file(src_file, dst_file)
+                    self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=get_file_size(src_file),
+                                    stage=stage)
                 self.set_file(self.src, rel_path, ref)
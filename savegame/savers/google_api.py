@@ -13,6 +13,8 @@ from googleapiclient.http import MediaIoBaseDownload
 
 from goth.autoauth import Autoauth
 
+from savegame.copier import HashingWriter
+
 SCOPES = [
     'https://www.googleapis.com/auth/contacts.readonly',
     'https://www.googleapis.com/auth/drive.readonly',
@@ -163,12 +165,14 @@ class GoogleCloud:
     def export_file(self, file_id, path, mime_type):
         service = self._get_drive_service()
         request = service.files().export_media(fileId=file_id, mimeType=mime_type)
-        fh = io.FileIO(path, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            logger.debug(f'{path} download progress: {int(status.progress() * 100)}%')
+        with io.FileIO(path, 'wb') as fh:
+            writer = HashingWriter(fh)
+            downloader = MediaIoBaseDownload(writer, request)
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+                logger.debug(f'{path} download progress: {int(status.progress() * 100)}%')
+        return writer.hexdigest()
 
     def _get_people_service(self):
         if not self.oauth_creds:
@@ -1,6 +1,7 @@
 from datetime import datetime, timezone
 import logging
 import os
+import threading
 import time
 
 from savegame.savers.base import BaseSaver, Skipped
@@ -9,6 +10,9 @@ from savegame.utils import FileRef, get_file_mtime, get_file_size, get_hash, to_
 
 logger = logging.getLogger(__name__)
 
+_creds_locks = {}
+_creds_locks_lock = threading.Lock()
+
 
 def ts_to_dt(ts):
     return datetime.fromtimestamp(ts, tz=timezone.utc)
@@ -25,9 +29,22 @@ def get_google_cloud(config, headless=True):
     return GoogleCloud(oauth_secrets_file=oauth_secrets_file, headless=headless)
 
 
-class GoogleDriveSaver(BaseSaver):
-    id = 'google_drive'
+def get_creds_lock(config):
+    with _creds_locks_lock:
+        return _creds_locks.setdefault(config.GOOGLE_CREDS, threading.Lock())
+
+
+class GoogleCloudSaver(BaseSaver):
     hostname = 'google_cloud'
+    network_bound = True
+
+    def run(self):
+        with get_creds_lock(self.config):   # the savers sharing credentials refresh the same oauth token
+            super().run()
+
+
+class GoogleDriveSaver(GoogleCloudSaver):
+    id = 'google_drive'
 
     def do_run(self):
         gc = get_google_cloud(self.config)
@@ -44,20 +61,19 @@ class GoogleDriveSaver(BaseSaver):
                 os.makedirs(os.path.dirname(dst_file), exist_ok=True)
                 start_ts = time.time()
                 try:
-                    gc.export_file(file_id=file_meta['id'], path=dst_file, mime_type=file_meta['mime_type'])
-                    file_ref = FileRef.from_file(dst_file, has_src_file=False)
-                    self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=get_file_size(dst_file))
+                    dst_hash = gc.export_file(file_id=file_meta['id'], path=dst_file, mime_type=file_meta['mime_type'])
+                    file_ref = self.get_dst_file_ref(dst_file, hash=dst_hash)   # tree hashed if large, like on the next runs
+                    self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=file_ref.size)
                 except Exception as e:
                     logger.error(f'failed to save google drive file {file_meta["name"]}: {e}')
                     self.report.add(self, rel_path=rel_path, code='failed')
             elif os.path.exists(dst_file):
-                file_ref = FileRef.from_file(dst_file, has_src_file=False)
+                file_ref = self.get_dst_file_ref(dst_file)
             self.set_file(self.src, rel_path, file_ref.ref)
 
 
-class GoogleContactsSaver(BaseSaver):
+class GoogleContactsSaver(GoogleCloudSaver):
     id = 'google_contacts'
-    hostname = 'google_cloud'
 
     def do_run(self):
         gc = get_google_cloud(self.config)
@@ -50,7 +50,7 @@ class VirtualboxSaver(BaseSaver):
                 else:
                     remove_path(dst_file)
                     os.rename(tmp_file, dst_file)
-                    file_ref = FileRef.from_file(dst_file, has_src_file=False)
+                    file_ref = self.get_dst_file_ref(dst_file)
                     self.report.add(self, rel_path=rel_path, code='saved', start_ts=start_ts, size=get_file_size(dst_file))
                     self.notifier.send(title=f'exported vm {vm}', body=f'to {dst_file}', replace_key=notif_key)
             self.set_file(self.src, rel_path, file_ref.ref)
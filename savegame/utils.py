@@ -1,14 +1,21 @@
-from collections import defaultdict
-from copy import deepcopy
-from fnmatch import fnmatch
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from fnmatch import translate
 import hashlib
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import random
+import re
 import shutil
 import socket
+import sqlite3
 import sys
+import threading
 import time
+from types import MappingProxyType
 
 from svcutils.service import list_mountpoint_labels
 
@@ -17,10 +24,33 @@ from savegame import NAME, WORK_DIR
 HOSTNAME = socket.gethostname()
 USERNAME = os.getlogin()
 REF_FILENAME = f'.{NAME}'
+BLOCKS_FILENAME = f'{REF_FILENAME}.blocks'
+INDEX_FILENAME = f'{REF_FILENAME}.index'   # legacy index shared by the hosts, removed on rebuild
+REF_FILENAMES = {REF_FILENAME, f'{REF_FILENAME}.tmp', BLOCKS_FILENAME, INDEX_FILENAME}
+SHARD_EXT = '.db'
+SQLITE_HEADER = b'SQLite format 3\x00'
 METADATA_MAX_AGE = 3600 * 24 * 90
+METADATA_JOURNAL_MAX_ENTRIES = 1000
 INVALID_PATH_SEP = {'linux': '\\', 'win32': '/'}[sys.platform]
 MTIME_DRIFT_TOLERANCE = 10
 MAX_HASH_FILE_SIZE = 1_000_000_000
+HASH_CACHE_MAX_AGE = 3600 * 24 * 30
+SCAN_CACHE_MAX_AGE = 3600 * 24 * 30
+CACHE_TOUCH_DELTA = 3600 * 24   # the last use ts of a cache entry is only updated once a day
+CACHE_JOURNAL_MIN_ENTRIES = 1000
+SAVE_REF_INDEX_MAX_AGE = 3600 * 24 * 7
+CHECKPOINT_FILES = 1000
+CHECKPOINT_DELTA = 60
+HASH_CACHE_RACY_DELTA = 2
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_MIN_SIZE = 64 * 1024 * 1024
+HASH_STRATEGY = 'readinto'   # see benchmarks/bench_hashing.py
+TREE_HASH_CHUNK_SIZE = 64 * 1024 * 1024
+TREE_HASH_WORKERS = 4
+HASH_SERVICE_WORKERS = os.cpu_count() or 1
+HASH_SERVICE_MIN_SIZE = 4 * 1024 * 1024   # less data is hashed in the calling thread
+HASH_SERVICE_BATCH_SIZE = 64 * 1024 * 1024
+HASH_SERVICE_BATCH_FILES = 256
 
 logger = logging.getLogger(__name__)
 
@@ -37,10 +67,38 @@ class DeprecatedSaveRef(Exception):
     pass
 
 
+class SaveRefError(Exception):
+    pass
+
+
+def get_shard_filename(hostname):
+    return f'{REF_FILENAME}.{hostname}{SHARD_EXT}'
+
+
+def parse_shard_filename(name):
+    """Returns the hostname of a SaveRef shard filename, None for other filenames."""
+    prefix = f'{REF_FILENAME}.'
+    if name.startswith(prefix) and name.endswith(SHARD_EXT) and len(name) > len(prefix) + len(SHARD_EXT):
+        return name[len(prefix):-len(SHARD_EXT)]
+    return None
+
+
+def is_ref_file(name):
+    name = name.removesuffix('-journal')   # sqlite rollback journals
+    return name in REF_FILENAMES or parse_shard_filename(name) is not None
+
+
 class NotFound(Exception):
     pass
 
 
+def get_stat(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
 def get_file_mtime(path, default=None):
     try:
         return os.path.getmtime(path)
@@ -61,6 +119,16 @@ def to_json(path):
     return json.dumps(path, sort_keys=True, indent=4)
 
 
+def write_json_file(file, data, **kwargs):
+    """Writes a temp file and renames it, so a crash leaves either the previous or the new data."""
+    tmp_file = f'{file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fd:
+        json.dump(data, fd, **kwargs)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_file, file)
+
+
 def remove_path(path):
     try:
         if os.path.isdir(path):
@@ -71,20 +139,397 @@ def remove_path(path):
         pass
 
 
-def get_file_hash(file, chunk_size=8192):
-    if not os.path.exists(file):
+def is_racy(st):
+    # a file modified within the mtime granularity could keep the same fingerprint after another change
+    return time.time_ns() - st.st_mtime_ns < HASH_CACHE_RACY_DELTA * 1_000_000_000
+
+
+class JournaledStore:
+    """Dict stored as a JSON snapshot and an append-only journal of the updated keys.
+
+    The journal is replayed over the snapshot on load and compacted into a new snapshot once it grows too large.
+    """
+    _lock = None
+    file = None
+    journal_file = None
+    indent = None
+    data = {}
+
+    def _load(self):
+        try:
+            with open(self.file, 'r', encoding='utf-8') as fd:
+                self.data = json.load(fd)
+        except Exception:
+            self.data = {}
+        self.updated_keys = set()
+        self.journal_size = 0
+        if self._replay_journal() is False:
+            self._compact()
+
+    def _replay_journal(self):
+        """Applies the journal entries, returns False if it ends with a partial entry."""
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as fd:
+                for line in fd:
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError('missing end of line')
+                        key, value = json.loads(line)
+                    except ValueError:
+                        logger.warning(f'ignored partial entry in {self.journal_file}')
+                        return False
+                    if value is None:
+                        self.data.pop(key, None)
+                    else:
+                        self.data[key] = value
+                    self.journal_size += 1
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _compact(self):
+        write_json_file(self.file, self.data, sort_keys=True, indent=self.indent)
+        remove_path(self.journal_file)
+        self.journal_size = 0
+
+    def _get_journal_max_entries(self):
+        return max(CACHE_JOURNAL_MIN_ENTRIES, len(self.data))
+
+    def _is_expired(self, value):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+            self.updated_keys.add(key)
+
+    def _pop(self, key):
+        with self._lock:
+            if self.data.pop(key, None) is not None:
+                self.updated_keys.add(key)
+
+    def _touch(self, key):
+        with self._lock:
+            self.updated_keys.add(key)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        for key in [k for k, v in self.data.items() if self._is_expired(v)]:
+            del self.data[key]
+            self.updated_keys.add(key)
+        if not os.path.exists(self.file) or self.journal_size + len(self.updated_keys) > self._get_journal_max_entries():
+            self._compact()
+        elif self.updated_keys:
+            with open(self.journal_file, 'a', encoding='utf-8') as fd:
+                for key in sorted(self.updated_keys):
+                    fd.write(json.dumps([key, self.data.get(key)], sort_keys=True) + '\n')
+                fd.flush()
+                os.fsync(fd.fileno())
+            self.journal_size += len(self.updated_keys)
+        self.updated_keys = set()
+
+
+class HashCache(JournaledStore):
+    """File hashes keyed by path and validated against (st_dev, st_ino, st_size, st_mtime_ns)."""
+    _instance = None
+    _lock = threading.RLock()
+    file = os.path.join(WORK_DIR, '.hash_cache.json')
+    journal_file = f'{file}.journal'
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance.hits = 0
+                instance.misses = 0
+                instance._load()
+                cls._instance = instance
+        return cls._instance
+
+    @staticmethod
+    def _get_fingerprint(st):
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+    @staticmethod
+    def _get_key(path, tree):
+        return f'tree:{path}' if tree else path
+
+    def get(self, path, st, tree=False):
+        key = self._get_key(path, tree)
+        item = self.data.get(key)
+        if item and item[:4] == self._get_fingerprint(st):
+            now = int(time.time())
+            if item[5] < now - CACHE_TOUCH_DELTA:
+                item[5] = now
+                self._touch(key)
+            with self._lock:
+                self.hits += 1
+            return item[4]
+        with self._lock:
+            self.misses += 1
         return None
+
+    def set(self, path, st, hash):
+        key = self._get_key(path, tree=is_tree_hash(hash))
+        if is_racy(st):
+            self._pop(key)
+            return
+        self._set(key, self._get_fingerprint(st) + [hash, int(time.time())])
+
+    def _is_expired(self, value):
+        return value[5] < time.time() - HASH_CACHE_MAX_AGE
+
+    def _save(self):
+        super()._save()
+        logger.info(f'hash cache: {self.hits} hits, {self.misses} misses, {len(self.data)} entries')
+
+
+_buffers = threading.local()
+
+
+def _get_buffer(size):
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def _hash_fd_read(fd, md5_hash, size, buffer_size):
+    while chunk := fd.read(buffer_size):
+        md5_hash.update(chunk)
+
+
+def _hash_fd_readinto(fd, md5_hash, size, buffer_size):
+    buffer = _get_buffer(buffer_size)
+    view = memoryview(buffer)
+    while read_size := fd.readinto(buffer):
+        md5_hash.update(view[:read_size])
+
+
+def _hash_fd_mmap(fd, md5_hash, size, buffer_size):
+    # a file truncated while mapped raises SIGBUS, so this is only used when explicitly selected
+    if size < HASH_MMAP_MIN_SIZE:
+        return _hash_fd_readinto(fd, md5_hash, size, buffer_size)
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for offset in range(0, len(mm), buffer_size):
+                md5_hash.update(view[offset:offset + buffer_size])
+        finally:
+            view.release()
+
+
+HASH_STRATEGIES = {
+    'read': _hash_fd_read,
+    'readinto': _hash_fd_readinto,
+    'mmap': _hash_fd_mmap,
+}
+
+
+def _hash_file(file, chunk_size=HASH_BUFFER_SIZE, strategy=HASH_STRATEGY, size=None):
     md5_hash = hashlib.md5()
+    with open(file, 'rb', buffering=0) as fd:
+        HASH_STRATEGIES[strategy](fd, md5_hash, os.fstat(fd.fileno()).st_size if size is None else size, chunk_size)
+    return md5_hash.hexdigest()
+
+
+def _hash_files(files, chunk_size=HASH_BUFFER_SIZE, strategy=HASH_STRATEGY):
+    """Runs in the hash service processes, the hash of a missing file is None."""
+    hashes = []
+    for file in files:
+        try:
+            hashes.append(_hash_file(file, chunk_size, strategy))
+        except FileNotFoundError:
+            hashes.append(None)
+    return hashes
+
+
+class HashService:
+    """Process pool hashing files for all the savers, loaders and the monitor, so hashing is not bound by the GIL.
+
+    Small files are hashed in batches to amortize the inter-process overhead. Hashing falls back to the calling thread
+    for small amounts of data or if the pool breaks.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance.executor = None
+                instance.disabled = False
+                cls._instance = instance
+        return cls._instance
+
+    def _get_executor(self):
+        with self._lock:
+            if not (self.executor or self.disabled):
+                # spawned rather than forked from a process running threads
+                self.executor = ProcessPoolExecutor(max_workers=HASH_SERVICE_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def _disable(self, error):
+        logger.warning(f'hashing in the calling threads, the hash service failed: {error!r}')
+        with self._lock:
+            self.disabled = True
+        self.close()
+
+    def hash_files(self, files, chunk_size=HASH_BUFFER_SIZE, strategy=HASH_STRATEGY):
+        executor = self._get_executor()
+        if executor:
+            try:
+                return executor.submit(_hash_files, files, chunk_size, strategy).result()
+            except BrokenExecutor as e:
+                self._disable(e)
+        return _hash_files(files, chunk_size, strategy)
+
+    def _set_hashes(self, batch, hashes):
+        for (file, st), hash in zip(batch, hashes):
+            if hash:
+                HashCache().set(file, st, hash)
+            yield file, hash
+
+    def iterate_file_hashes(self, files):
+        """Yields (file, hash) for the (file, stat) items, in the order the hashes are computed."""
+        batches, batch, batch_size, total_size = [], [], 0, 0
+        for file, st in files:
+            hash = HashCache().get(file, st)
+            if hash:
+                yield file, hash
+                continue
+            batch.append((file, st))
+            batch_size += st.st_size
+            total_size += st.st_size
+            if batch_size >= HASH_SERVICE_BATCH_SIZE or len(batch) >= HASH_SERVICE_BATCH_FILES:
+                batches.append(batch)
+                batch, batch_size = [], 0
+        if batch:
+            batches.append(batch)
+        executor = self._get_executor() if total_size >= HASH_SERVICE_MIN_SIZE else None
+        if not executor:
+            for batch in batches:
+                yield from self._set_hashes(batch, _hash_files([f for f, st in batch]))
+            return
+        pending, next_index = {}, 0
+        try:
+            while next_index < len(batches):
+                pending[executor.submit(_hash_files, [f for f, st in batches[next_index]])] = batches[next_index]
+                next_index += 1
+            for future in as_completed(list(pending)):
+                hashes = future.result()
+                yield from self._set_hashes(pending.pop(future), hashes)
+        except BrokenExecutor as e:
+            self._disable(e)
+            for batch in list(pending.values()) + batches[next_index:]:   # the batches not yielded yet
+                yield from self._set_hashes(batch, _hash_files([f for f, st in batch]))
+
+    def warm_cache(self, files):
+        """Hashes the existing files, so the next get_file_hash calls hit the cache."""
+        items = [(f, st) for f, st in ((f, get_stat(f)) for f in files) if st]
+        for _ in self.iterate_file_hashes(items):
+            pass
+
+    def close(self):
+        with self._lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
+
+
+def get_file_hash(file, chunk_size=HASH_BUFFER_SIZE, use_cache=True, st=None, strategy=HASH_STRATEGY, use_service=True):
+    try:
+        st = st or os.stat(file)
+    except FileNotFoundError:
+        return None
+    if use_cache:
+        cached_hash = HashCache().get(file, st)
+        if cached_hash:
+            return cached_hash
     start_ts = time.time()
-    with open(file, 'rb') as fd:
-        while chunk := fd.read(chunk_size):
-            md5_hash.update(chunk)
+    if use_service and st.st_size >= HASH_SERVICE_MIN_SIZE:
+        hash = HashService().hash_files([file], chunk_size, strategy)[0]
+        if not hash:
+            return None
+    else:
+        try:
+            hash = _hash_file(file, chunk_size, strategy, size=st.st_size)
+        except FileNotFoundError:   # removed since it was stat'ed
+            return None
     duration = time.time() - start_ts
     if duration > 10:
-        logger.warning(f'get_file_hash {file} took {duration:.02f}s ({os.path.getsize(file) / 1024 / 1024:.02f} MB)')
+        logger.warning(f'get_file_hash {file} took {duration:.02f}s ({st.st_size / 1024 / 1024:.02f} MB)')
+    if use_cache:
+        HashCache().set(file, st, hash)
+    return hash
+
+
+def _hash_chunk(file, offset, size, buffer_size=HASH_BUFFER_SIZE):
+    md5_hash = hashlib.md5()
+    view = memoryview(_get_buffer(buffer_size))
+    with open(file, 'rb', buffering=0) as fd:
+        fd.seek(offset)
+        while size > 0 and (read_size := fd.readinto(view[:min(size, buffer_size)])):
+            md5_hash.update(view[:read_size])
+            size -= read_size
     return md5_hash.hexdigest()
 
 
+def is_tree_hash(hash):
+    return bool(hash) and hash.startswith('tree')
+
+
+def parse_tree_hash(hash):
+    chunk_size, root_hash = hash[len('tree'):].split('-', 1)
+    return int(chunk_size), root_hash
+
+
+def get_tree_hash(chunk_hashes, chunk_size):
+    return f'tree{chunk_size}-{get_hash("".join(chunk_hashes))}'
+
+
+def get_file_tree_hash(file, chunk_size=None, workers=None, use_cache=True, st=None):
+    """Hashes fixed-size chunks in parallel (hashlib releases the GIL) and returns the root hash and the chunk hashes.
+
+    The chunk hashes are None when the root hash comes from the cache.
+    """
+    chunk_size = chunk_size or TREE_HASH_CHUNK_SIZE
+    st = st or os.stat(file)
+    if use_cache:
+        cached_hash = HashCache().get(file, st, tree=True)
+        if cached_hash and parse_tree_hash(cached_hash)[0] == chunk_size:
+            return cached_hash, None
+    start_ts = time.time()
+    with ThreadPoolExecutor(max_workers=workers or TREE_HASH_WORKERS) as executor:
+        chunk_hashes = list(executor.map(lambda offset: _hash_chunk(file, offset, chunk_size), range(0, st.st_size, chunk_size)))
+    logger.info(f'tree hashed {file} in {time.time() - start_ts:.02f}s ({st.st_size / 1024 / 1024:.02f} MB)')
+    hash = get_tree_hash(chunk_hashes, chunk_size)
+    if use_cache:
+        HashCache().set(file, st, hash)
+    return hash, chunk_hashes
+
+
+def check_file_tree_hash_sample(file, hash, chunk_hashes, time_budget, st=None):
+    """Checks random chunks until the time budget is spent, returns None if the chunk hashes do not match the hash."""
+    chunk_size, _ = parse_tree_hash(hash)
+    if get_tree_hash(chunk_hashes, chunk_size) != hash:
+        return None
+    st = st or os.stat(file)
+    if len(range(0, st.st_size, chunk_size)) != len(chunk_hashes):
+        return False
+    end_ts = time.time() + time_budget
+    for index in random.sample(range(len(chunk_hashes)), len(chunk_hashes)):
+        if _hash_chunk(file, index * chunk_size, chunk_size) != chunk_hashes[index]:
+            return False
+        if time.time() > end_ts:
+            break
+    return True
+
+
 def get_hash(data, encoding='utf-8'):
     return hashlib.md5(data.encode(encoding)).hexdigest()
 
@@ -93,18 +538,35 @@ def get_file_size(file, default=None):
     return os.path.getsize(file) if os.path.exists(file) else default
 
 
-def check_patterns(path, include=None, exclude=None):
-    if exclude:
-        for pattern in exclude:
-            if fnmatch(path, pattern):
-                return False
+class PatternMatcher:
+    """Include and exclude fnmatch patterns compiled into single regexes, exclude patterns taking precedence."""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+        self.prune_exclude = self._compile([r for r in exclude or [] if r.endswith('*')])
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(translate(os.path.normcase(r)) for r in patterns))
+
+    def match(self, path):
+        path = os.path.normcase(path)
+        if self.exclude:
+            return not self.exclude.match(path)
+        if self.include:
+            return bool(self.include.match(path))
         return True
-    if include:
-        for pattern in include:
-            if fnmatch(path, pattern):
-                return True
-        return False
-    return True
+
+    def must_prune(self, dir_path):
+        # a pattern ending with '*' which matches the dir path with a trailing separator matches every path below it
+        return bool(self.prune_exclude and self.prune_exclude.match(os.path.normcase(dir_path + os.sep)))
+
+
+def check_patterns(path, include=None, exclude=None):
+    return PatternMatcher(include, exclude).match(path)
 
 
 def list_label_mountpoints():
@@ -118,72 +580,309 @@ def coalesce(*values):
     return None
 
 
-def walk_files(path):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            yield os.path.join(root, file)
+class FileEntry:
+    """A walked path with the stat result of files, so callers do not stat them again."""
+    __slots__ = ('path', 'stat', 'is_dir')
+
+    def __init__(self, path, stat=None, is_dir=False):
+        self.path = path
+        self.stat = stat
+        self.is_dir = is_dir
 
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r})'
 
-class Metadata:
+
+def walk_entries(path, include_dirs=False, topdown=True, prune=None):
+    """Walks path with os.scandir like os.walk (errors ignored, symlinked dirs not followed), yielding FileEntry objects.
+
+    Dirs for which prune(dir_path) is true are not entered.
+    """
+    try:
+        scandir_it = os.scandir(path)
+    except OSError:
+        return
+    dir_entries = []
+    with scandir_it:
+        for entry in scandir_it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dir_entries.append(entry)
+                continue
+            try:
+                yield FileEntry(entry.path, entry.stat())
+            except FileNotFoundError:
+                logger.debug(f'skipped broken link {entry.path}')
+    for entry in dir_entries:
+        if prune and prune(entry.path):
+            continue
+        if include_dirs and topdown:
+            yield FileEntry(entry.path, is_dir=True)
+        if not entry.is_symlink():
+            yield from walk_entries(entry.path, include_dirs=include_dirs, topdown=topdown, prune=prune)
+        if include_dirs and not topdown:
+            yield FileEntry(entry.path, is_dir=True)
+
+
+class ScanCache:
+    """Dir listings validated against the dir mtime, and the src file fingerprints confirmed by each saver.
+
+    A dir mtime only changes when entries are added, removed or renamed, so the listed files are still stat'ed.
+    Stored in SQLite, so only the changed dir listings and confirmed files are written.
+    """
     _instance = None
-    file = os.path.join(WORK_DIR, '.meta.json')
-    data = {}
+    _lock = threading.RLock()
+    file = os.path.join(WORK_DIR, '.scan_cache.db')
+    legacy_file = os.path.join(WORK_DIR, '.scan_cache.json')
+    _schema = """
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, files TEXT, dirs TEXT, ts INTEGER)
+            WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS savers (key TEXT PRIMARY KEY, ts INTEGER) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS files (key TEXT, rel_path TEXT, fingerprint TEXT, PRIMARY KEY (key, rel_path))
+            WITHOUT ROWID;
+    """
 
     def __new__(cls):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-            cls._instance._load()
+        with cls._lock:
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance._load()
+                cls._instance = instance
         return cls._instance
 
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.file)
+        try:
+            with conn:
+                conn.executescript(self._schema)
+                yield conn
+        finally:
+            conn.close()
+
     def _load(self):
+        self.dirs = {}
+        self.files = {}   # loaded per saver key
+        self.updated_dirs = set()
+        for file in (self.legacy_file, f'{self.legacy_file}.journal'):
+            remove_path(file)
+        try:
+            with self._connect() as conn:
+                for path, mtime_ns, files, dirs, ts in conn.execute('SELECT path, mtime_ns, files, dirs, ts FROM dirs'):
+                    self.dirs[path] = [mtime_ns, json.loads(files), json.loads(dirs), ts]
+        except sqlite3.OperationalError:   # e.g. locked, the listings are not cached for this run
+            logger.exception(f'failed to load {self.file}')
+        except sqlite3.DatabaseError:
+            logger.exception(f'failed to load {self.file}, recreating it')
+            remove_path(self.file)
+
+    def _list_dir(self, path, st):
+        item = self.dirs.get(path)
+        if item and item[0] == st.st_mtime_ns:
+            now = int(time.time())
+            if item[3] < now - CACHE_TOUCH_DELTA:
+                with self._lock:
+                    item[3] = now
+                    self.updated_dirs.add(path)
+            return item[1], item[2]
+        files, dirs = [], []
+        with os.scandir(path) as scandir_it:
+            for entry in scandir_it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+        with self._lock:
+            if is_racy(st):
+                if self.dirs.pop(path, None) is not None:
+                    self.updated_dirs.add(path)
+            else:
+                self.dirs[path] = [st.st_mtime_ns, files, dirs, int(time.time())]
+                self.updated_dirs.add(path)
+        return files, dirs
+
+    def walk(self, path, prune=None):
+        """Yields the file entries like walk_entries, listing the unchanged dirs from the cache."""
+        try:
+            files, dirs = self._list_dir(path, os.stat(path))
+        except OSError:
+            return
+        for name in files:
+            file = os.path.join(path, name)
+            try:
+                yield FileEntry(file, os.stat(file))
+            except FileNotFoundError:
+                logger.debug(f'skipped missing file {file}')
+        for name in dirs:
+            dir_path = os.path.join(path, name)
+            if not (prune and prune(dir_path)):
+                yield from self.walk(dir_path, prune=prune)
+
+    def get_files(self, key):
+        with self._lock:
+            if key not in self.files:
+                with self._connect() as conn:
+                    rows = conn.execute('SELECT rel_path, fingerprint FROM files WHERE key = ?', (key,)).fetchall()
+                self.files[key] = {r: json.loads(f) for r, f in rows}
+            return self.files[key]
+
+    def set_files(self, key, files):
+        """Writes the changed confirmed files of the saver right away, as they are only valid with its saved refs."""
+        with self._lock:
+            stored_files = self.get_files(key)
+            removed = [(key, r) for r in stored_files.keys() - files.keys()]
+            changed = [(key, r, json.dumps(f)) for r, f in files.items() if stored_files.get(r) != f]
+            with self._connect() as conn:
+                conn.executemany('DELETE FROM files WHERE key = ? AND rel_path = ?', removed)
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', changed)
+                conn.execute('INSERT OR REPLACE INTO savers VALUES (?, ?)', (key, int(time.time())))
+            self.files[key] = files
+
+    def save(self):
+        with self._lock:
+            min_ts = time.time() - SCAN_CACHE_MAX_AGE
+            for path in [p for p, v in self.dirs.items() if v[3] < min_ts]:
+                del self.dirs[path]
+                self.updated_dirs.add(path)
+            with self._connect() as conn:
+                conn.executemany('DELETE FROM dirs WHERE path = ?', [(p,) for p in self.updated_dirs if p not in self.dirs])
+                conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                                 [(p, v[0], json.dumps(v[1]), json.dumps(v[2]), v[3])
+                                  for p in self.updated_dirs if (v := self.dirs.get(p))])
+                expired_keys = [r for r in conn.execute('SELECT key FROM savers WHERE ts < ?', (min_ts,))]
+                conn.executemany('DELETE FROM files WHERE key = ?', expired_keys)
+                conn.executemany('DELETE FROM savers WHERE key = ?', expired_keys)
+            for key, in expired_keys:
+                self.files.pop(key, None)
+            self.updated_dirs = set()
+
+
+class Checkpoint:
+    """Files confirmed by a running saver, appended to a journal in WORK_DIR every CHECKPOINT_FILES files
+    or CHECKPOINT_DELTA seconds, so an interrupted run can resume without comparing them again.
+
+    The journal is removed once the save ref is saved.
+    """
+
+    def __init__(self, key):
+        self.file = os.path.join(WORK_DIR, f'.checkpoint.{key}.jsonl')
+        self.pending = []
+        self.ts = time.time()
+
+    def load(self):
+        """Returns the (src fingerprint, ref) by rel path."""
+        files = {}
         try:
             with open(self.file, 'r', encoding='utf-8') as fd:
-                self.data = json.load(fd)
-        except Exception:
-            self.data = {}
+                for line in fd:
+                    try:
+                        rel_path, fingerprint, ref = json.loads(line)
+                    except ValueError:   # partially written
+                        continue
+                    files[rel_path] = (tuple(fingerprint), ref)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def add(self, rel_path, fingerprint, ref):
+        self.pending.append([rel_path, list(fingerprint), ref])
+        if len(self.pending) >= CHECKPOINT_FILES or time.time() > self.ts + CHECKPOINT_DELTA:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with open(self.file, 'a', encoding='utf-8') as fd:
+                for row in self.pending:
+                    fd.write(json.dumps(row) + '\n')
+                fd.flush()
+                os.fsync(fd.fileno())
+            self.pending = []
+        self.ts = time.time()
+
+    def remove(self):
+        self.pending = []
+        try:
+            os.remove(self.file)
+        except FileNotFoundError:
+            pass
+
+
+def walk_files(path):
+    for entry in walk_entries(path):
+        yield entry.path
+
+
+class Metadata(JournaledStore):
+    """Saver metadata, stored as a JSON snapshot and an append-only journal of the updated keys."""
+    _instance = None
+    _lock = threading.RLock()
+    file = os.path.join(WORK_DIR, '.meta.json')
+    journal_file = f'{file}.journal'
+    indent = 4
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance._load()
+                cls._instance = instance
+        return cls._instance
 
     def get(self, key):
         return self.data.get(key, {})
 
     def set(self, key, value: dict):
-        self.data[key] = value
+        self._set(key, value)
 
     def set_subkey(self, key, subkey, value):
-        self.data[key][subkey] = value
+        with self._lock:
+            self.data[key][subkey] = value
+            self.updated_keys.add(key)
 
-    def save(self):
-        max_ts = time.time() - METADATA_MAX_AGE
-        self.data = {k: v for k, v in self.data.items() if v.get('next_ts') > max_ts}
-        with open(self.file, 'w', encoding='utf-8') as fd:
-            json.dump(self.data, fd, sort_keys=True, indent=4)
+    def _get_journal_max_entries(self):
+        return METADATA_JOURNAL_MAX_ENTRIES
 
+    def _is_expired(self, value):
+        return not value.get('next_ts') > time.time() - METADATA_MAX_AGE
 
-def nested_dict():
-    return defaultdict(nested_dict)
 
+def iterate_save_refs(path):
+    for dst in SaveRefIndex(path).iterate_dsts():
+        try:
+            yield SaveRef(dst)
+        except SaveRefError as e:
+            logger.error(e)
 
-def dict_to_nested(d):
-    """Recursively cast a dict into a nested defaultdict."""
-    if isinstance(d, dict):
-        return defaultdict(nested_dict, {k: dict_to_nested(v) for k, v in d.items()})
-    return d
 
-
-def iterate_save_refs(path):
-    for file in walk_files(path):
-        if os.path.basename(file) == REF_FILENAME:
-            yield SaveRef(os.path.dirname(file))
+def get_fingerprint(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino) if st else None
 
 
 class FileRef:
     @classmethod
-    def from_file(cls, file, has_src_file=True):
-        size = get_file_size(file)
+    def from_file(cls, file, has_src_file=True, hash=None):
+        """hash is the md5 computed while writing the file, used instead of reading it unless it is tree hashed."""
+        try:
+            st = os.stat(file)
+        except FileNotFoundError:
+            return cls(has_src_file=has_src_file)
+        if st.st_size < MAX_HASH_FILE_SIZE:
+            hash, chunk_hashes = hash or get_file_hash(file, st=st), None
+        else:
+            hash, chunk_hashes = get_file_tree_hash(file, st=st)
         return cls(
-            hash=get_file_hash(file) if (size is not None and size < MAX_HASH_FILE_SIZE) else None,
-            size=size,
-            mtime=get_file_mtime(file),
+            hash=hash,
+            size=st.st_size,
+            mtime=st.st_mtime,
             has_src_file=has_src_file,
+            chunk_hashes=chunk_hashes,
         )
 
     @classmethod
@@ -202,103 +901,483 @@ class FileRef:
             has_src_file = bool(int(parts[3]))
         except Exception:
             has_src_file = True
-        return cls(hash=hash, size=size, mtime=mtime, has_src_file=has_src_file)
+        try:
+            fingerprint = tuple(int(r) for r in parts[4].split('/'))
+        except Exception:
+            fingerprint = None
+        return cls(hash=hash, size=size, mtime=mtime, has_src_file=has_src_file, fingerprint=fingerprint)
 
-    def __init__(self, hash=None, size=None, mtime=None, has_src_file=True):
+    def __init__(self, hash=None, size=None, mtime=None, has_src_file=True, fingerprint=None, chunk_hashes=None):
         self.hash = hash
         self.size = size
         self.mtime = mtime
         self.has_src_file = has_src_file
+        self.fingerprint = fingerprint   # dst file (size, mtime_ns, inode) when the ref was recorded
+        self.chunk_hashes = chunk_hashes   # tree hash chunks, not part of the ref
 
     @property
     def ref(self):
-        return ':'.join(map(str, [self.hash or '', self.size or '', self.mtime or '', int(self.has_src_file)]))
+        parts = [self.hash or '', self.size or '', self.mtime or '', int(self.has_src_file)]
+        if self.fingerprint:
+            parts.append('/'.join(map(str, self.fingerprint)))
+        return ':'.join(map(str, parts))
 
     def _check_mtime(self, mtime):
         return abs(mtime - self.mtime) <= MTIME_DRIFT_TOLERANCE
 
-    def check_file(self, file):
+    def _check_tree_hash(self, file, st, chunk_hashes=None, time_budget=None):
+        if chunk_hashes and time_budget and HashCache().get(file, st, tree=True) != self.hash:
+            res = check_file_tree_hash_sample(file, self.hash, chunk_hashes, time_budget, st=st)
+            if res is not None:
+                return res
+        return get_file_tree_hash(file, chunk_size=parse_tree_hash(self.hash)[0], st=st)[0] == self.hash
+
+    def check_file(self, file, chunk_hashes=None, time_budget=None, st=None):
+        st = st or get_stat(file)
+        if not st:
+            return False
+        if is_tree_hash(self.hash):
+            return self._check_tree_hash(file, st, chunk_hashes, time_budget)
         if self.hash:
-            return get_file_hash(file) == self.hash
+            return get_file_hash(file, st=st) == self.hash
         if self.size is not None and self.mtime is not None:
-            return get_file_size(file) == self.size and self._check_mtime(get_file_mtime(file))
+            return st.st_size == self.size and self._check_mtime(st.st_mtime)
         return False
 
 
+class SaveRefIndex:
+    """SaveRef locations below a root dst path, kept per host in WORK_DIR and rebuilt with a single walk when stale.
+
+    The subdir names of the dirs leading to the indexed dsts are recorded too, so a dst created by another host
+    (or without the index) is detected with a scandir per recorded dir.
+    """
+    _instances = {}
+    _lock = threading.RLock()
+
+    def __new__(cls, root):
+        with cls._lock:
+            if root not in cls._instances:
+                instance = super().__new__(cls)
+                instance.root = root
+                instance.file = os.path.join(WORK_DIR, f'.save_ref_index.{get_hash(root)}.json')
+                instance._load()
+                cls._instances[root] = instance
+        return cls._instances[root]
+
+    def _load(self):
+        try:
+            with open(self.file, 'r', encoding='utf-8') as fd:
+                self.data = json.load(fd)
+        except FileNotFoundError:
+            self.data = None
+        except Exception:
+            logger.exception(f'failed to load index file {self.file}')
+            self.data = None
+
+    def _save(self):
+        write_json_file(self.file, self.data, sort_keys=True, indent=4)
+
+    def _list_subdirs(self, rel_path):
+        try:
+            with os.scandir(os.path.normpath(os.path.join(self.root, rel_path))) as entries:
+                return sorted(e.name for e in entries if e.is_dir(follow_symlinks=False))
+        except OSError:
+            return None
+
+    def _iterate_parent_dirs(self, rel_dst):
+        """Yields the (rel path, subdir name) of the dirs from the root to dst."""
+        rel_path = '.'
+        for name in [] if rel_dst == '.' else rel_dst.split(os.sep):
+            yield rel_path, name
+            rel_path = os.path.normpath(os.path.join(rel_path, name))
+
+    def rebuild(self):
+        rel_dsts = []
+        for entry in walk_entries(self.root):
+            if os.path.basename(entry.path) == REF_FILENAME:
+                rel_dsts.append(os.path.relpath(os.path.dirname(entry.path), self.root))
+        dirs = {}
+        for rel_dst in rel_dsts:
+            for rel_path, name in self._iterate_parent_dirs(rel_dst):
+                if rel_path not in dirs:
+                    dirs[rel_path] = self._list_subdirs(rel_path)
+        self.data = {'ts': time.time(), 'dsts': sorted(rel_dsts), 'dirs': dirs}
+        self._save()
+        remove_path(os.path.join(self.root, INDEX_FILENAME))
+        logger.info(f'indexed {len(rel_dsts)} save refs in {self.root}')
+
+    def set(self, dst):
+        """Adds a dst saved by this host, keeping the recorded subdirs of the other dirs as they were."""
+        rel_dst = os.path.relpath(dst, self.root)
+        with self._lock:
+            if self.data is None or rel_dst in self.data['dsts'] or rel_dst.startswith(os.pardir):
+                return
+            for rel_path, name in self._iterate_parent_dirs(rel_dst):
+                names = self.data['dirs'].get(rel_path)
+                if names is None:
+                    self.data['dirs'][rel_path] = self._list_subdirs(rel_path)
+                elif name not in names:
+                    self.data['dirs'][rel_path] = sorted(names + [name])
+            self.data['dsts'] = sorted(self.data['dsts'] + [rel_dst])
+            self._save()
+
+    def _is_stale(self):
+        if self.data is None or time.time() - self.data['ts'] > SAVE_REF_INDEX_MAX_AGE:
+            return True
+        # removed dsts are skipped when iterating, only new subdirs can hold unknown dsts
+        return any(set(self._list_subdirs(p) or []) - set(n or []) for p, n in self.data['dirs'].items())
+
+    def iterate_dsts(self):
+        with self._lock:
+            if self._is_stale():
+                self.rebuild()
+            rel_dsts = self.data['dsts']
+        for rel_dst in rel_dsts:
+            dst = os.path.normpath(os.path.join(self.root, rel_dst))
+            if os.path.exists(os.path.join(dst, REF_FILENAME)):
+                yield dst
+
+
 class SaveRef:
+    """Refs of the files saved in dst, stored in one SQLite shard per hostname next to a small shared header.
+
+    A host only ever writes its own shard, so hosts sharing a synced dst do not rewrite each other's refs.
+    Refs being updated are kept in memory per (hostname, src) until save, which only writes the changed rows.
+    """
     _instances = {}
-    _version = '20250928'
+    _version = 2
+    _json_version = '20250928'   # migrated on load
+    _header_schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+    """
+    _shard_schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS files (src TEXT, rel_path TEXT, ref, PRIMARY KEY (src, rel_path)) WITHOUT ROWID;
+    """
+
+    _lock = threading.Lock()
 
     def __new__(cls, dst):
-        if dst not in cls._instances:
-            cls._instances[dst] = super().__new__(cls)
-            cls._instances[dst].dst = dst
-            cls._instances[dst].file = os.path.join(dst, REF_FILENAME)
-            cls._instances[dst].data = None
-            cls._instances[dst].files = None
-            cls._instances[dst]._load()
+        with cls._lock:
+            if dst not in cls._instances:
+                instance = super().__new__(cls)
+                instance.dst = dst
+                instance.file = os.path.join(dst, REF_FILENAME)
+                instance.files = {}
+                instance._load()
+                cls._instances[dst] = instance
         return cls._instances[dst]
 
-    def _read_file(self):
+    @contextmanager
+    def _connect(self, file):
+        conn = sqlite3.connect(file)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _get_shard_file(self, hostname):
+        return os.path.join(self.dst, get_shard_filename(hostname))
+
+    def _list_shard_hostnames(self):
+        try:
+            return {h for h in map(parse_shard_filename, os.listdir(self.dst)) if h}
+        except FileNotFoundError:
+            return set()
+
+    def _init_header(self):
+        """Writes the header to a temp file first, so an interrupted creation never leaves a partial header."""
+        tmp_file = f'{self.file}.tmp'
+        remove_path(tmp_file)
+        with self._connect(tmp_file) as conn:
+            conn.executescript(self._header_schema)
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('version', self._version))
+        os.replace(tmp_file, self.file)
+
+    def _init_shard(self, conn):
+        conn.executescript(self._shard_schema)
+
+    def _write_shards(self, hosts, rows):
+        for hostname, ts in hosts:
+            with self._connect(self._get_shard_file(hostname)) as conn:
+                self._init_shard(conn)
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('ts', ts))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                 [(s, r, v) for h, s, r, v in rows if h == hostname])
+
+    def _read_json_file(self):
+        """Returns None if the file is not a JSON object, e.g. a truncated header."""
         try:
             with open(self.file, 'r', encoding='utf-8') as fd:
                 data = json.load(fd)
-            if data.get('version') != self._version:
-                raise DeprecatedSaveRef()
-            return data
+        except Exception:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def _migrate_json_file(self):
+        data = self._read_json_file()
+        if data is None:
+            logger.error(f'invalid ref file {self.file}, recreating the header')
+            self._init_header()   # the shards are committed independently
+            return
+        if data.get('version') != self._json_version:
+            self._remove_files()
+            logger.info(f'removed deprecated save reference {self.file}')
+            return
+        for hostname in self._list_shard_hostnames():
+            remove_path(self._get_shard_file(hostname))
+        hosts = set(data.get('ts', {}).items())
+        rows = [(h, s, r, v) for h, src_files in data.get('files', {}).items()
+                for s, file_refs in src_files.items() for r, v in file_refs.items()]
+        self._write_shards(hosts | {(h, 0) for h in data.get('files', {}).keys() - data.get('ts', {}).keys()}, rows)
+        self._init_header()   # once the shards are written, so an interrupted migration starts over
+        logger.info(f'migrated save reference {self.file} to sqlite')
+
+    def _remove_files(self):
+        for file in [self.file] + [self._get_shard_file(h) for h in self._list_shard_hostnames()]:
+            remove_path(file)
+
+    def _load(self):
+        self.files = {}
+        try:
+            with open(self.file, 'rb') as fd:
+                header = fd.read(len(SQLITE_HEADER))
         except FileNotFoundError:
-            pass
+            return
+        if header != SQLITE_HEADER:
+            self._migrate_json_file()
+            return
+        try:
+            with self._connect(self.file) as conn:
+                version = None
+                if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchall():
+                    version = conn.execute('SELECT value FROM meta WHERE key = ?', ('version',)).fetchall()
+            if not version:   # e.g. an empty database, the shards are committed independently
+                self._init_header()
+            elif version[0][0] != self._version:
+                raise DeprecatedSaveRef()
         except DeprecatedSaveRef:
-            os.remove(self.file)
+            self._remove_files()
             logger.info(f'removed deprecated save reference {self.file}')
-        except Exception:
-            if os.path.exists(self.file):
-                os.remove(self.file)
-            logger.exception(f'failed to load ref file {self.file}')
-        return {'ts': {}, 'version': self._version}
-
-    def _load(self, data=None):
-        self.data = data or self._read_file()
-        self.files = dict_to_nested(self.data.get('files', {}))
-
-    def _purge_files(self, hostname=HOSTNAME):
-        for src, file_refs in self.get_files().items():
-            for rel_path in file_refs.keys():
-                if not os.path.exists(os.path.join(self.dst, normalize_path(rel_path))):
-                    self.files[hostname][src].pop(rel_path, None)
-        for src, file_refs in self.get_files().items():
-            if not file_refs:
-                self.files[hostname].pop(src)
-        if not self.files[hostname]:
-            self.files.pop(hostname)
-
-    def save(self, hostname=HOSTNAME, force=False):
-        self._purge_files(hostname)
-        data_update = {'files': self.files}
-        if not (force or data_update != {k: self.data.get(k) for k in data_update.keys()}):
+        except sqlite3.OperationalError as e:   # locked or unreadable, the caller can retry later
+            raise SaveRefError(f'failed to load ref file {self.file}: {e}') from e
+        except sqlite3.DatabaseError:
+            logger.exception(f'failed to load ref file {self.file}, recreating the header')
+            self._init_header()   # the shards are committed independently
+
+    def _query(self, hostname, sql, params=()):
+        file = self._get_shard_file(hostname)
+        if not os.path.exists(file):
+            return []
+        with self._connect(file) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _read_files(self, hostname, src):
+        return dict(self._query(hostname, 'SELECT rel_path, ref FROM files WHERE src = ?', (src,)))
+
+    def _get_src_files(self, hostname, src):
+        key = (hostname, src)
+        if key not in self.files:
+            self.files[key] = self._read_files(hostname, src)
+        return self.files[key]
+
+    def _get_srcs(self, hostname):
+        srcs = {r[0] for r in self._query(hostname, 'SELECT DISTINCT src FROM files')}
+        return sorted(srcs | {s for h, s in self.files.keys() if h == hostname})
+
+    def get_hostnames(self):
+        return sorted(self._list_shard_hostnames() | {h for h, s in self.files.keys()})
+
+    def _list_dst_files(self, rel_paths):
+        """Lists once each dst dir containing the rel paths."""
+        dst_files = set()
+        for dir_path in {os.path.dirname(os.path.join(self.dst, normalize_path(r))) for r in rel_paths}:
+            try:
+                dst_files.update(os.path.join(dir_path, n) for n in os.listdir(dir_path))
+            except OSError:
+                pass
+        return dst_files
+
+    def _purge_files(self, hostname=HOSTNAME, dst_files=None):
+        """Removes the refs of the missing dst files, returns the removed rows of the srcs not loaded in memory.
+
+        dst_files is the set of existing dst files when already listed by the caller.
+        """
+        refs = list(self.iterate_files(hostname=hostname))
+        if dst_files is None:
+            dst_files = self._list_dst_files(r for s, r, v in refs)
+        removed = []
+        for src, rel_path, ref in refs:
+            if os.path.join(self.dst, normalize_path(rel_path)) not in dst_files:
+                if (hostname, src) in self.files:
+                    del self.files[(hostname, src)][rel_path]
+                else:
+                    removed.append((src, rel_path))
+        return removed
+
+    def save(self, hostname=HOSTNAME, force=False, dst_files=None):
+        """Writes the changed refs to the hostname shard only."""
+        removed = self._purge_files(hostname, dst_files=dst_files)
+        changed = []
+        srcs = [s for h, s in self.files.keys() if h == hostname]
+        for src in srcs:
+            file_refs = self.files.pop((hostname, src))
+            stored_refs = self._read_files(hostname, src)
+            removed.extend((src, r) for r in stored_refs.keys() - file_refs.keys())
+            changed.extend((src, r, v) for r, v in file_refs.items() if r not in stored_refs or stored_refs[r] != v)
+        if not (force or removed or changed):
             return
-        self.data.update(data_update)
-        self.data['ts'][hostname] = time.time()
-        with open(self.file, 'w', encoding='utf-8') as fd:
-            json.dump(self.data, fd, sort_keys=True, indent=4)
-        self._load(self.data)
+        if not os.path.exists(self.file):
+            self._init_header()
+        with self._connect(self._get_shard_file(hostname)) as conn:
+            self._init_shard(conn)
+            conn.executemany('DELETE FROM files WHERE src = ? AND rel_path = ?', removed)
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', changed)
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('ts', time.time()))
+
+    def iterate_files(self, src=None, hostname=HOSTNAME):
+        """Yields (src, rel_path, ref), reading the srcs not loaded in memory from the database."""
+        for src in [src] if src else self._get_srcs(hostname):
+            file_refs = self.files.get((hostname, src))
+            if file_refs is None:
+                yield from self._query(hostname, 'SELECT src, rel_path, ref FROM files WHERE src = ?', (src,))
+            else:
+                for rel_path, ref in file_refs.items():
+                    yield src, rel_path, ref
 
     def get_files(self, src=None, hostname=HOSTNAME):
-        return deepcopy(self.files[hostname][src] if src else self.files[hostname])
+        """Returns read-only views of the refs."""
+        if src:
+            file_refs = self.files.get((hostname, src))
+            return MappingProxyType(self._read_files(hostname, src) if file_refs is None else file_refs)
+        return {s: self.get_files(s, hostname=hostname) for s in self._get_srcs(hostname)}
 
     def reset_files(self, src, hostname=HOSTNAME):
-        files = self.get_files(src, hostname=hostname)
-        self.files[hostname][src].clear()
+        key = (hostname, src)
+        files = self.files[key] if key in self.files else self._read_files(hostname, src)
+        self.files[key] = {}
         return files
 
     def set_file(self, src, rel_path, ref, hostname=HOSTNAME):
-        self.files[hostname][src][rel_path] = ref
+        self._get_src_files(hostname, src)[rel_path] = ref
 
     def get_dst_files(self, src=None, hostname=HOSTNAME):
-        files = self.get_files(hostname=hostname)
-        if src:
-            return {os.path.join(self.dst, r) for r in files[src].keys()}
-        return {os.path.join(self.dst, r) for file_refs in files.values() for r in file_refs.keys()}
+        return {os.path.join(self.dst, r) for s, r, v in self.iterate_files(src, hostname=hostname)}
 
     def get_ts(self, hostname=HOSTNAME):
-        return self.data.get('ts', {}).get(hostname, 0)
+        res = self._query(hostname, 'SELECT value FROM meta WHERE key = ?', ('ts',))
+        return res[0][0] if res else 0
+
+
+class VolumeSemaphore:
+    """Semaphore whose limit can be lowered while it is held."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def acquire(self, blocking=True):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.active < self.limit, timeout=None if blocking else 0):
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class VolumeLimiter:
+    """Semaphores bounding the concurrent file operations per volume and role (src or dst).
+
+    The limit of a volume is the lowest limit requested for it, e.g. by a save item with dst_workers set to 1 for a
+    spinning disk.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls)
+                cls._instance.semaphores = {}
+        return cls._instance
+
+    def get(self, role, path, limit):
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        key = (role, os.stat(path).st_dev)
+        with self._lock:
+            semaphore = self.semaphores.get(key)
+            if not semaphore:
+                semaphore = self.semaphores[key] = VolumeSemaphore(limit)
+            elif limit < semaphore.limit:
+                logger.info(f'lowered the {role} limit of {path} volume from {semaphore.limit} to {limit}')
+                semaphore.set_limit(limit)
+            return semaphore
+
+
+class BlockRef:
+    """Per-block hashes of large dst files, used to rewrite only the changed blocks and to sample-check tree hashes."""
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __new__(cls, dst):
+        with cls._lock:
+            if dst not in cls._instances:
+                instance = super().__new__(cls)
+                instance.dst = dst
+                instance.file = os.path.join(dst, BLOCKS_FILENAME)
+                instance._load()
+                cls._instances[dst] = instance
+        return cls._instances[dst]
+
+    def _load(self):
+        self.updated = False
+        try:
+            with open(self.file, 'r', encoding='utf-8') as fd:
+                self.data = json.load(fd)
+        except FileNotFoundError:
+            self.data = {}
+        except Exception:
+            logger.exception(f'failed to load blocks file {self.file}')
+            self.data = {}
+
+    def get_blocks(self, rel_path, block_size, dst_stat=None):
+        item = self.data.get(rel_path)
+        if not item or item['block_size'] != block_size:
+            return []
+        if dst_stat and tuple(item['fingerprint']) != get_fingerprint(dst_stat):
+            return []
+        return item['blocks']
+
+    def set_blocks(self, rel_path, fingerprint, block_size, blocks):
+        self.data[rel_path] = {'block_size': block_size, 'fingerprint': fingerprint, 'blocks': blocks}
+        self.updated = True
+
+    def save(self):
+        data = {k: v for k, v in self.data.items() if os.path.exists(os.path.join(self.dst, normalize_path(k)))}
+        if not (self.updated or data != self.data):
+            return
+        self.data = data
+        if self.data:
+            write_json_file(self.file, self.data, sort_keys=True)
+        else:
+            remove_path(self.file)
+        self.updated = False
@@ -0,0 +1,207 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+POLL_TIMEOUT = 1
+MAX_DIRTY_PATHS = 100_000
+
+logger = logging.getLogger(__name__)
+
+
+class WatchError(Exception):
+    def __init__(self, message, errno=None):
+        super().__init__(message)
+        self.errno = errno
+
+
+class Inotify:
+    """Recursive inotify watcher built on ctypes, calling callback(path) for each changed path.
+
+    callback(None) means events were lost (queue overflow or watch limit reached).
+    The dirs for which prune(dir_path) is True are not watched, so excluded trees do not use up the watch limit.
+    """
+
+    def __init__(self, callback, prune=None):
+        if sys.platform != 'linux':
+            raise WatchError(f'inotify is not available on {sys.platform}')
+        self.callback = callback
+        self.prune = prune
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(f'failed to init inotify: {os.strerror(ctypes.get_errno())}')
+        self.paths = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):   # removed in the meantime
+                return
+            raise WatchError(f'failed to watch {path}: {os.strerror(error)}', errno=error)
+        with self.lock:
+            self.paths[wd] = path
+
+    def _must_prune(self, path):
+        return bool(self.prune and self.prune(path))
+
+    def add_tree(self, root):
+        self._add_watch(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not self._must_prune(os.path.join(dirpath, d))]
+            for dirname in dirnames:
+                self._add_watch(os.path.join(dirpath, dirname))
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('inotify queue overflow')
+            self.callback(None)
+            return
+        with self.lock:
+            dirname = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+        if not dirname or mask & IN_IGNORED:
+            return
+        path = os.path.join(dirname, name) if name else dirname
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not self._must_prune(path):
+            try:
+                self.add_tree(path)
+            except WatchError as e:
+                logger.warning(str(e))
+                self.callback(None)
+        self.callback(path)
+
+    def _run(self):
+        while not self.closed:
+            if not select.select([self.fd], [], [], POLL_TIMEOUT)[0]:
+                continue
+            data = os.read(self.fd, READ_SIZE)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+                offset += size
+                try:
+                    self._handle_event(wd, mask, name)
+                except Exception:
+                    logger.exception('failed to handle inotify event')
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        os.close(self.fd)
+
+
+class ChangeJournal:
+    """Paths changed under the watched src paths between two runs, per saver key.
+
+    get_dirty_paths returns None when the changes are unknown (first run, lost events), meaning a full scan is required.
+    The src paths hitting the inotify watch limit are not watched again until the next process.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance.roots = {}
+                instance.prunes = {}
+                instance.dirty_paths = {}
+                instance.disabled = {}
+                instance.lock = threading.Lock()
+                instance.inotify = None
+                cls._instance = instance
+        return cls._instance
+
+    def _on_change(self, path):
+        with self.lock:
+            for key, root in self.roots.items():
+                dirty_paths = self.dirty_paths[key]
+                if dirty_paths is None:
+                    continue
+                if path is None or len(dirty_paths) >= MAX_DIRTY_PATHS:
+                    self.dirty_paths[key] = None
+                elif path == root or path.startswith(root + os.sep):
+                    dirty_paths.add(path)
+
+    def _must_prune(self, path):
+        """Returns True if the path is pruned by all the watched roots containing it."""
+        with self.lock:
+            prunes = [self.prunes.get(k) for k, r in self.roots.items() if path.startswith(r + os.sep)]
+        return bool(prunes) and all(p and p(path) for p in prunes)
+
+    def _watch(self, key, root, prune=None):
+        with self.lock:
+            if not self.inotify:
+                self.inotify = Inotify(self._on_change, prune=self._must_prune)
+            self.roots[key] = root
+            self.prunes[key] = prune
+            self.dirty_paths[key] = set()
+        self.inotify.add_tree(root)
+        logger.info(f'watching {root}')
+
+    def get_dirty_paths(self, key, root, prune=None):
+        if self.disabled.get(key) == root:
+            return None
+        if self.roots.get(key) != root:
+            try:
+                self._watch(key, root, prune=prune)
+            except WatchError as e:
+                self.invalidate(key)
+                if e.errno == errno.ENOSPC:
+                    logger.warning(f'inotify watch limit reached, not watching {root} anymore: {e}')
+                    self.disabled[key] = root
+                else:
+                    logger.warning(f'failed to watch {root}: {e}')
+            return None
+        with self.lock:
+            dirty_paths = self.dirty_paths[key]
+            self.dirty_paths[key] = set()
+        return dirty_paths
+
+    def invalidate(self, key):
+        with self.lock:
+            self.roots.pop(key, None)
+            self.prunes.pop(key, None)
+            self.dirty_paths.pop(key, None)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        with self.lock:
+            self.roots = {}
+            self.prunes = {}
+            self.dirty_paths = {}
+            self.disabled = {}
@@ -1,5 +1,7 @@
+from concurrent.futures import Future
 from copy import deepcopy
 from datetime import datetime, timedelta, timezone
+import errno
 from fnmatch import fnmatch
 from glob import glob
 import json
@@ -7,8 +9,10 @@ import os
 from pprint import pformat, pprint
 import shutil
 import socket
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
 import unittest
 from unittest.mock import Mock, patch
@@ -16,7 +20,7 @@ from unittest.mock import Mock, patch
 from svcutils.service import Config
 
 from tests import WORK_DIR, module
-from savegame import load, save, savers, utils
+from savegame import compare, copier, load, save, savers, utils, watcher
 from savegame.loaders.file import FileLoader
 from savegame.savers import virtualbox
 
@@ -87,6 +91,24 @@ class PatternTestCase(unittest.TestCase):
         self.assertTrue(utils.check_patterns(self.file, exclude=['*third*']))
         self.assertTrue(utils.check_patterns(self.file, exclude=['*.bin']))
 
+    def test_matcher(self):
+        matcher = utils.PatternMatcher(include=['*.bin', '*game*'], exclude=['*third*', '*.tmp'])
+        self.assertTrue(matcher.match(self.file))
+        self.assertFalse(matcher.match(self.file + '.tmp'))
+        matcher = utils.PatternMatcher(include=['*.bin', '*game*'])
+        self.assertTrue(matcher.match(self.file))
+        self.assertFalse(matcher.match(os.path.join(os.path.dirname(self.file), 'file.txt')))
+        self.assertTrue(utils.PatternMatcher().match(self.file))
+
+    def test_prune(self):
+        matcher = utils.PatternMatcher(exclude=['*/node_modules/*', '*.py', '*/second_*'])
+        dirname = os.path.dirname(self.file)
+        self.assertTrue(matcher.must_prune(os.path.join(dirname, 'node_modules')))
+        self.assertTrue(matcher.must_prune(dirname))
+        self.assertFalse(matcher.must_prune(os.path.dirname(dirname)))
+        self.assertFalse(matcher.must_prune(os.path.join(os.path.dirname(dirname), 'node_modules_old')))
+        self.assertFalse(utils.PatternMatcher(include=['*/node_modules/*']).must_prune(os.path.join(dirname, 'node_modules')))
+
 
 class BaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -101,8 +123,14 @@ class BaseTestCase(unittest.TestCase):
         os.makedirs(self.dst_root, exist_ok=True)
 
         utils.SaveRef._instances = {}
+        utils.BlockRef._instances = {}
+        utils.SaveRefIndex._instances = {}
+        utils.VolumeLimiter._instance = None
+        remove_path(utils.ScanCache.file)
+        utils.ScanCache._instance = None
         self.meta = utils.Metadata()
         self.meta.data = {}
+        utils.HashCache().data = {}
         self.config = self._get_config(
             SAVES=[],
             GOOGLE_CREDS=GOOGLE_CREDS,
@@ -130,6 +158,16 @@ class BaseTestCase(unittest.TestCase):
     def _generate_dst_data(self, index_start, nb_srcs=2, nb_dirs=2, nb_files=2, file_version=1):
         self._generate_data(self.dst_root, index_start, nb_srcs, nb_dirs, nb_files, file_version)
 
+    def _create_file(self, file, content, mtime=None):
+        """Writes the str or bytes content, file being relative to dst_root unless absolute."""
+        file = os.path.join(self.dst_root, file)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'w' if isinstance(content, str) else 'wb') as fd:
+            fd.write(content)
+        if mtime is not None:
+            os.utime(file, (mtime, mtime))
+        return file
+
     def _get_src_paths(self, index_start=1, nb_srcs=2, **kwargs):
         return [os.path.join(self.src_root, f'src{i}') for i in range(index_start, index_start + nb_srcs)]
 
@@ -171,9 +209,13 @@ class BaseTestCase(unittest.TestCase):
     def _switch_dst_data_hostname(self, from_hostname, to_hostname):
         def switch_hostname(file):
             save_ref = utils.SaveRef(os.path.dirname(file))
-            save_ref.files[to_hostname] = save_ref.get_files(hostname=from_hostname)
-            save_ref.files[from_hostname].clear()
-            save_ref.save()
+            for src, file_refs in save_ref.get_files(hostname=from_hostname).items():
+                save_ref.reset_files(src, hostname=from_hostname)
+                save_ref.reset_files(src, hostname=to_hostname)
+                for rel_path, ref in file_refs.items():
+                    save_ref.set_file(src, rel_path, ref, hostname=to_hostname)
+            save_ref.save(hostname=from_hostname)
+            save_ref.save(hostname=to_hostname)
 
         for base_dir in os.listdir(os.path.join(self.dst_root)):
             for saver_id in os.listdir(os.path.join(self.dst_root, base_dir)):
@@ -196,7 +238,10 @@ class BaseTestCase(unittest.TestCase):
             if username_str not in src:
                 return
             new_src = src.replace(username_str, f'{os.sep}{to_username}{os.sep}')
-            save_ref.files = {HOSTNAME: {new_src: files[src]}}
+            save_ref.reset_files(src)
+            save_ref.reset_files(new_src)
+            for rel_path, ref in files[src].items():
+                save_ref.set_file(new_src, rel_path, ref)
             save_ref.save()
 
         for path in walk_paths(self.dst_root):
@@ -258,14 +303,127 @@ class MetadataTestCase(BaseTestCase):
         self.assertEqual(m2.get('key1')['next_ts'], now)
         self.assertEqual(m2.get('key2'), {})
 
+    def test_journal(self):
+        m1 = utils.Metadata()
+        for file in (m1.file, m1.journal_file):
+            remove_path(file)
+        m1._load()
+        now = time.time()
+        m1.set('key1', {'next_ts': now})
+        m1.save()
+        self.assertFalse(os.path.exists(m1.journal_file))
 
-class FileRefTestCase(BaseTestCase):
-    def _create_file(self, name, content):
-        file = os.path.join(self.dst_root, name)
-        with open(file, 'w') as fd:
-            fd.write(content)
-        return file
+        m1.set('key2', {'next_ts': now})
+        m1.set_subkey('key1', 'next_warning_ts', now)
+        m1.save()
+        with open(m1.file, 'r', encoding='utf-8') as fd:
+            self.assertEqual(json.load(fd), {'key1': {'next_ts': now}})
+        with open(m1.journal_file, 'a', encoding='utf-8') as fd:
+            fd.write('["key3", {"next')   # interrupted write
+
+        m1._load()
+        self.assertEqual(m1.data, {'key1': {'next_ts': now, 'next_warning_ts': now}, 'key2': {'next_ts': now}})
+        self.assertFalse(os.path.exists(m1.journal_file))
+        with open(m1.file, 'r', encoding='utf-8') as fd:
+            self.assertEqual(json.load(fd), m1.data)
+
+        with patch.object(utils, 'METADATA_JOURNAL_MAX_ENTRIES', 1):
+            m1.set('key1', {'next_ts': now + 1})
+            m1.save()
+            self.assertTrue(os.path.exists(m1.journal_file))
+            m1.set('key2', {'next_ts': now + 1})
+            m1.save()
+        self.assertFalse(os.path.exists(m1.journal_file))
+        with open(m1.file, 'r', encoding='utf-8') as fd:
+            self.assertEqual(json.load(fd), {'key1': {'next_ts': now + 1}, 'key2': {'next_ts': now + 1}})
+
+
+class VolumeLimiterTestCase(BaseTestCase):
+    def test_get(self):
+        utils.VolumeLimiter._instance = None
+        limiter = utils.VolumeLimiter()
+        sem = limiter.get('src', self.src_root, 3)
+        self.assertIs(limiter.get('src', os.path.join(self.src_root, 'missing', 'file1'), 4), sem)
+        self.assertIsNot(limiter.get('dst', self.src_root, 3), sem)
+        self.assertTrue(sem.acquire(blocking=False))
+        self.assertTrue(sem.acquire(blocking=False))
+        self.assertIs(limiter.get('src', self.src_root, 1), sem)   # the lowest limit wins, even while held
+        self.assertFalse(sem.acquire(blocking=False))
+        sem.release()
+        self.assertFalse(sem.acquire(blocking=False))
+        sem.release()
+        self.assertTrue(sem.acquire(blocking=False))
+        sem.release()
+
+    def _run_savers(self, savers_per_volume):
+        self._generate_src_data(index_start=1, nb_srcs=4, nb_dirs=1, nb_files=1)
+        saves = [
+            {
+                'src_paths': [os.path.join(self.src_root, f'src{i}') for i in range(1, 5)],
+                'dst_path': self.dst_root,
+            },
+        ]
+        lock = threading.Lock()
+        active = []
+        max_active = []
+        orig_do_run = savers.file.FileSaver.do_run
+
+        def side_do_run(saver):
+            with lock:
+                active.append(1)
+                max_active.append(len(active))
+            time.sleep(.05)
+            try:
+                return orig_do_run(saver)
+            finally:
+                with lock:
+                    active.pop()
+
+        utils.VolumeLimiter._instance = None
+        with patch.object(savers.file.FileSaver, 'do_run', autospec=True, side_effect=side_do_run), \
+                patch.object(save.SaveHandler, 'savers_per_volume', savers_per_volume):
+            self._savegame(saves=saves)
+        self.assertEqual(len(self.meta.data), 4)
+        self.assertTrue(all(d['success_ts'] for d in self.meta.data.values()))
+        return max(max_active)
+
+    def test_savers_1(self):
+        self.assertEqual(self._run_savers(savers_per_volume=1), 1)
+
+    def test_savers_2(self):
+        self.assertEqual(self._run_savers(savers_per_volume=2), 2)
+
+
+class WalkEntriesTestCase(BaseTestCase):
+    def test_1(self):
+        root = os.path.join(self.src_root, 'src1')
+        for rel_path in ('file1', 'dir1/file2', 'dir1/dir2/file3'):
+            file = os.path.join(root, rel_path)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'w') as fd:
+                fd.write(rel_path)
+        os.makedirs(os.path.join(root, 'dir3'))
+        os.symlink(os.path.join(root, 'dir1'), os.path.join(root, 'link1'))
+        os.symlink(os.path.join(root, 'missing'), os.path.join(root, 'link2'))
+
+        entries = list(utils.walk_entries(root))
+        self.assertEqual({os.path.relpath(e.path, root) for e in entries}, {'file1', 'dir1/file2', 'dir1/dir2/file3'})
+        for entry in entries:
+            self.assertEqual(entry.stat.st_size, len(os.path.relpath(entry.path, root)))
+        self.assertEqual(set(utils.walk_files(root)), {e.path for e in entries})
 
+        paths = [os.path.relpath(e.path, root) for e in utils.walk_entries(root, include_dirs=True, topdown=False)]
+        self.assertEqual(set(paths), {'file1', 'dir1', 'dir1/file2', 'dir1/dir2', 'dir1/dir2/file3', 'dir3', 'link1'})
+        self.assertTrue(paths.index('dir1/dir2/file3') < paths.index('dir1/dir2') < paths.index('dir1'))
+
+        matcher = utils.PatternMatcher(exclude=['*/dir2/*'])
+        with patch.object(os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            entries = list(utils.walk_entries(root, prune=matcher.must_prune))
+        self.assertEqual({os.path.relpath(e.path, root) for e in entries}, {'file1', 'dir1/file2'})
+        self.assertFalse(os.path.join(root, 'dir1', 'dir2') in [c.args[0] for c in mock_scandir.call_args_list])
+
+
+class FileRefTestCase(BaseTestCase):
     def test_from_file(self):
         file = self._create_file('file1', 'content')
         fr = utils.FileRef.from_file(file)
@@ -317,6 +475,13 @@ class FileRefTestCase(BaseTestCase):
         self.assertEqual(fr.size, 456)
         self.assertEqual(fr.mtime, 789.123)
         self.assertEqual(fr.has_src_file, False)
+        self.assertEqual(fr.fingerprint, None)
+
+        fr = utils.FileRef.from_ref('123:::1:456/789123/10')
+        self.assertEqual(fr.ref, '123:::1:456/789123/10')
+        self.assertEqual(fr.hash, '123')
+        self.assertEqual(fr.has_src_file, True)
+        self.assertEqual(fr.fingerprint, (456, 789123, 10))
 
     def test_check_file_ko(self):
         file1 = self._create_file('file1', 'content1')
@@ -343,12 +508,825 @@ class FileRefTestCase(BaseTestCase):
         self.assertTrue(fr.check_file(file2))
 
 
-class SaveRefTestCase(BaseTestCase):
-    def _create_file(self, file, content):
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        with open(file, 'w') as fd:
-            fd.write(content)
+class HashCacheTestCase(BaseTestCase):
+    def test_1(self):
+        hc = utils.HashCache()
+        file = self._create_file('file1', 'content1', mtime=time.time() - 60)
+        hash = utils.get_file_hash(file)
+        hits = hc.hits
+        with patch('builtins.open') as mock_open:
+            self.assertEqual(utils.get_file_hash(file), hash)
+            self.assertTrue(utils.FileRef(hash=hash).check_file(file))
+        mock_open.assert_not_called()
+        self.assertEqual(hc.hits, hits + 2)
+
+        file = self._create_file('file1', 'content2', mtime=time.time() - 60)
+        misses = hc.misses
+        self.assertNotEqual(utils.get_file_hash(file), hash)
+        self.assertEqual(hc.misses, misses + 1)
+
+        hc.save()
+        hc._load()
+        self.assertEqual(hc.data[file][4], utils.get_file_hash(file))
+
+    def test_recent_file(self):
+        hc = utils.HashCache()
+        file = self._create_file('file1', 'content1')
+        utils.get_file_hash(file)
+        self.assertFalse(file in hc.data)
+
+    def test_eviction(self):
+        hc = utils.HashCache()
+        file1 = self._create_file('file1', 'content1', mtime=time.time() - 60)
+        file2 = self._create_file('file2', 'content2', mtime=time.time() - 60)
+        utils.get_file_hash(file1)
+        utils.get_file_hash(file2)
+        hc.data[file1][5] = time.time() - utils.HASH_CACHE_MAX_AGE - 1
+        hc.save()
+        self.assertEqual(set(hc.data.keys()), {file2})
+
+    def test_journal(self):
+        hc = utils.HashCache()
+        for file in (hc.file, hc.journal_file):
+            remove_path(file)
+        hc._load()
+        file1 = self._create_file('file1', 'content1', mtime=time.time() - 60)
+        file2 = self._create_file('file2', 'content2', mtime=time.time() - 60)
+        utils.get_file_hash(file1)
+        hc.save()
+        self.assertFalse(os.path.exists(hc.journal_file))
+        utils.get_file_hash(file1)
+        utils.get_file_hash(file2)
+        with patch.object(utils, 'write_json_file') as mock_write:
+            hc.save()
+        mock_write.assert_not_called()
+        with open(hc.journal_file) as fd:
+            self.assertEqual([json.loads(r)[0] for r in fd], [file2])
+
+        hc.data = {}
+        hc._load()
+        self.assertEqual(set(hc.data.keys()), {file1, file2})
+        hc.data[file1][5] -= utils.CACHE_TOUCH_DELTA + 1
+        utils.get_file_hash(file1)
+        self.assertEqual(hc.updated_keys, {file1})
+
+
+class HashStrategyTestCase(BaseTestCase):
+    def test_1(self):
+        file = os.path.join(self.dst_root, 'file1')
+        with open(file, 'wb') as fd:
+            fd.write(os.urandom(3 * 1024 * 1024 + 123))
+        hashes = set()
+        with patch.object(utils, 'HASH_MMAP_MIN_SIZE', 1024):
+            for strategy in utils.HASH_STRATEGIES:
+                for chunk_size in (1000, 1024 * 1024):
+                    hashes.add(utils.get_file_hash(file, chunk_size=chunk_size, use_cache=False, strategy=strategy))
+        self.assertEqual(len(hashes), 1)
+
+
+class HashServiceTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utils.HashService._instance = None
+        self.files = []
+        for i in range(5):
+            file = os.path.join(self.src_root, f'file{i}')
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'wb') as fd:
+                fd.write(os.urandom(1000 * (i + 1)))
+            os.utime(file, (1, 1))   # not racy
+            self.files.append(file)
+        self.hashes = {f: utils.get_file_hash(f, use_cache=False, use_service=False) for f in self.files}
+
+    def tearDown(self):
+        utils.HashService().close()
+        utils.HashService._instance = None
+
+    def test_batch(self):
+        items = [(f, os.stat(f)) for f in self.files] + [(os.path.join(self.src_root, 'missing'), os.stat(self.files[0]))]
+        with patch.object(utils, 'HASH_SERVICE_MIN_SIZE', 0), patch.object(utils, 'HASH_SERVICE_BATCH_FILES', 2):
+            res = dict(utils.HashService().iterate_file_hashes(items))
+            self.assertTrue(utils.HashService().executor)
+            self.assertEqual(utils.get_file_hash(self.files[0], use_cache=False), self.hashes[self.files[0]])
+        self.assertEqual(res, self.hashes | {os.path.join(self.src_root, 'missing'): None})
+        for file in self.files:
+            self.assertEqual(utils.HashCache().get(file, os.stat(file)), self.hashes[file])
+
+    def test_small_batch(self):
+        utils.HashService().warm_cache(self.files)
+        self.assertIsNone(utils.HashService().executor)
+        for file in self.files:
+            self.assertEqual(utils.HashCache().get(file, os.stat(file)), self.hashes[file])
+
+    def test_broken_pool(self):
+        executor = Mock()
+        executor.submit.side_effect = utils.BrokenExecutor('broken')
+        utils.HashService().executor = executor
+        with patch.object(utils, 'HASH_SERVICE_MIN_SIZE', 0):
+            res = dict(utils.HashService().iterate_file_hashes([(f, os.stat(f)) for f in self.files]))
+            self.assertEqual(res, self.hashes)
+            self.assertTrue(utils.HashService().disabled)
+            self.assertEqual(utils.get_file_hash(self.files[0], use_cache=False), self.hashes[self.files[0]])
+        self.assertIsNone(utils.HashService().executor)
+
+    def _iterate_broken_pool(self, broken_index, submit_error=False):
+        utils.HashService._instance = None
+        utils.HashCache().data = {}
+        futures = []
+
+        def submit(func, files, *args):
+            if submit_error and len(futures) == broken_index:
+                raise utils.BrokenExecutor('broken')
+            future = Future()
+            if len(futures) >= broken_index:
+                future.set_exception(utils.BrokenExecutor('broken'))
+            else:
+                future.set_result(func(files, *args))
+            futures.append(future)
+            return future
+
+        utils.HashService().executor = Mock(submit=Mock(side_effect=submit))
+        with patch.object(utils, 'HASH_SERVICE_MIN_SIZE', 0), patch.object(utils, 'HASH_SERVICE_BATCH_FILES', 2), \
+                patch.object(utils, 'as_completed', side_effect=iter):   # in the submission order
+            res = list(utils.HashService().iterate_file_hashes([(f, os.stat(f)) for f in self.files]))
+        self.assertTrue(utils.HashService().disabled)
+        return res
+
+    def test_pool_broken_partway(self):
+        for broken_index in (1, 2):
+            for submit_error in (False, True):
+                res = self._iterate_broken_pool(broken_index, submit_error)
+                self.assertEqual(sorted(res), sorted(self.hashes.items()))
+
+
+class TreeHashTestCase(BaseTestCase):
+    def test_file_ref(self):
+        file = os.path.join(self.dst_root, 'file1')
+        data = os.urandom(10 * 1000 + 123)
+        self._create_file(file, data, mtime=1)
+        with patch.object(utils, 'MAX_HASH_FILE_SIZE', 1000), \
+                patch.object(utils, 'TREE_HASH_CHUNK_SIZE', 1000):
+            fr = utils.FileRef.from_file(file)
+            self.assertTrue(utils.is_tree_hash(fr.hash))
+            self.assertEqual(utils.parse_tree_hash(fr.hash)[0], 1000)
+            self.assertEqual(len(fr.chunk_hashes), 11)
+            self.assertEqual(utils.get_file_tree_hash(file, chunk_size=1000, workers=1, use_cache=False)[0], fr.hash)
+            self.assertEqual(utils.get_file_tree_hash(file, chunk_size=1000), (fr.hash, None))
+            self.assertNotEqual(utils.get_file_hash(file), fr.hash)
+            self.assertTrue(fr.check_file(file))
+
+            self._create_file(file, data[:5000] + b'x' + data[5001:], mtime=1)
+            utils.HashCache().data = {}
+            self.assertFalse(fr.check_file(file))
+            self.assertFalse(fr.check_file(file, chunk_hashes=fr.chunk_hashes, time_budget=10))
+            self.assertFalse(fr.check_file(file, chunk_hashes=['invalid'] * 11, time_budget=10))
+            self._create_file(file, data, mtime=1)
+            utils.HashCache().data = {}
+            self.assertTrue(fr.check_file(file, chunk_hashes=fr.chunk_hashes, time_budget=10))
+
+
+class CopierTestCase(BaseTestCase):
+    def test_copy_file(self):
+        src_file = os.path.join(self.src_root, 'file1')
+        dst_file = os.path.join(self.dst_root, 'file1')
+        os.makedirs(self.src_root, exist_ok=True)
+        with open(src_file, 'w') as fd:
+            fd.write('content1' * 1000)
+        os.utime(src_file, (time.time() - 60, time.time() - 60))
+        fr = copier.copy_file(src_file, dst_file)
+        with open(dst_file) as fd:
+            self.assertEqual(fd.read(), 'content1' * 1000)
+        self.assertEqual(fr.hash, utils.get_file_hash(src_file, use_cache=False))
+        self.assertEqual(fr.size, utils.get_file_size(src_file))
+        self.assertEqual(fr.mtime, utils.get_file_mtime(src_file))
+        self.assertEqual(fr.mtime, utils.get_file_mtime(dst_file))
+        self.assertEqual(fr.fingerprint, utils.get_fingerprint(os.stat(dst_file)))
+        self.assertEqual(utils.HashCache().data[dst_file][4], fr.hash)
+
+    def test_block_hashes(self):
+        src_file = os.path.join(self.src_root, 'file1')
+        dst_file = os.path.join(self.dst_root, 'file1')
+        os.makedirs(self.src_root, exist_ok=True)
+        data = ''.join(str(i) * 100 for i in range(5)) + 'end'
+        with open(src_file, 'w') as fd:
+            fd.write(data)
+        with patch.object(copier.ReflinkBackend, 'is_available', return_value=False), \
+                patch.object(copier.CopyEngine.buffered_backend, 'chunk_size', 150):   # not aligned on the blocks
+            fr = copier.copy_file(src_file, dst_file, block_size=100)
+        self.assertEqual(fr.chunk_hashes, [utils.get_hash(data[i:i + 100]) for i in range(0, len(data), 100)])
+        fr = copier.copy_file(src_file, dst_file, need_hash=False, block_size=100)
+        self.assertEqual(fr.chunk_hashes, None)   # not read
+
+    def test_backends(self):
+        src_file = os.path.join(self.src_root, 'file1')
+        dst_file = os.path.join(self.dst_root, 'file1')
+        os.makedirs(self.src_root, exist_ok=True)
+        with open(src_file, 'w') as fd:
+            fd.write('content1' * 1000)
+        engine = copier.CopyEngine()
+        engine.unsupported.clear()
+        engine.stats.clear()
+        hash = utils.get_file_hash(src_file, use_cache=False)
+
+        def side_effect(*args, **kwargs):
+            raise OSError(errno.EXDEV, 'cross-device link')
+
+        with patch.object(copier.ReflinkBackend, 'copy', side_effect=side_effect), \
+                patch.object(copier.CopyFileRangeBackend, 'copy', side_effect=side_effect), \
+                patch.object(copier.SendfileBackend, 'is_available', return_value=False):
+            fr = copier.copy_file(src_file, dst_file, need_hash=False)
+            self.assertEqual(fr.hash, None)
+            self.assertEqual(utils.get_file_hash(dst_file, use_cache=False), hash)
+            self.assertEqual(set(engine.stats.keys()), {'buffered'})
+            self.assertEqual(set().union(*engine.unsupported.values()), {'reflink', 'copy_file_range'})
+
+        engine.unsupported.clear()
+        engine.stats.clear()
+        os.remove(dst_file)
+        with patch.object(copier.ReflinkBackend, 'is_available', return_value=False):
+            fr = copier.copy_file(src_file, dst_file, need_hash=False)
+        self.assertEqual(utils.get_file_hash(dst_file, use_cache=False), hash)
+        self.assertEqual(engine.stats['copy_file_range']['files'], 1)
+        self.assertEqual(engine.stats['copy_file_range']['bytes'], 8000)
+
+
+class ConcurrencyTestCase(BaseTestCase):
+    def _run(self, dst_workers):
+        src = os.path.join(self.src_root, 'src1')
+        for i in range(8):
+            os.makedirs(src, exist_ok=True)
+            with open(os.path.join(src, f'file{i}'), 'w') as fd:
+                fd.write(f'content{i}')
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+                'dst_workers': dst_workers,
+            },
+        ]
+        lock = threading.Lock()
+        active = []
+        max_active = []
+        orig_copy_file = savers.base.copy_file
+
+        def side_copy_file(*args, **kwargs):
+            with lock:
+                active.append(1)
+                max_active.append(len(active))
+            time.sleep(.05)
+            try:
+                return orig_copy_file(*args, **kwargs)
+            finally:
+                with lock:
+                    active.pop()
+
+        utils.VolumeLimiter._instance = None
+        with patch.object(savers.base, 'copy_file', side_effect=side_copy_file):
+            self._savegame(saves=saves)
+        dst_paths = self._list_dst_root_paths()
+        rf = list(self._list_save_ref_files(dst_paths).values())[0]
+        self.assertEqual(list(list(rf.values())[0].keys()), [f'file{i}' for i in range(8)])
+        return max(max_active)
 
+    def test_1(self):
+        self.assertEqual(self._run(dst_workers=1), 1)
+
+    def test_2(self):
+        self.assertTrue(self._run(dst_workers=4) > 1)
+
+    def test_pending_files(self):
+        src = os.path.join(self.src_root, 'src1')
+        os.makedirs(src)
+        for i in range(20):
+            with open(os.path.join(src, f'file{i:02d}'), 'w') as fd:
+                fd.write(f'content{i}')
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+                'src_workers': 2,
+                'dst_workers': 2,
+            },
+        ]
+        submitted, applied, max_pending = [], [], []
+        orig_submit = savers.file.ThreadPoolExecutor.submit
+        orig_apply_result = savers.file.FileSaver._apply_result
+
+        def side_submit(executor, fn, *args, **kwargs):
+            if getattr(fn, '__name__', None) == '_save_file':
+                submitted.append(1)
+            return orig_submit(executor, fn, *args, **kwargs)
+
+        def side_apply_result(*args, **kwargs):
+            max_pending.append(len(submitted) - len(applied))
+            applied.append(1)
+            return orig_apply_result(*args, **kwargs)
+
+        with patch.object(savers.file.ThreadPoolExecutor, 'submit', autospec=True, side_effect=side_submit), \
+                patch.object(savers.file.FileSaver, '_apply_result', autospec=True, side_effect=side_apply_result), \
+                patch.object(savers.file, 'PENDING_FILES_PER_WORKER', 2):
+            self._savegame(saves=saves)
+        self.assertEqual(len(applied), 20)
+        self.assertEqual(max(max_pending), 5)   # 2 workers * 2 files + the file just submitted
+
+
+class SaveHandlerTestCase(BaseTestCase):
+    def test_network_savers(self):
+        self._generate_src_data(index_start=1, nb_srcs=2, nb_dirs=1, nb_files=1)
+        saves = [
+            {
+                'saver_id': 'google_drive',
+                'dst_path': os.path.join(self.dst_root, 'dst1'),
+            },
+            {
+                'saver_id': 'google_contacts',
+                'dst_path': os.path.join(self.dst_root, 'dst2'),
+            },
+            {
+                'src_paths': [os.path.join(self.src_root, f'src{i}') for i in range(1, 3)],
+                'dst_path': self.dst_root,
+            },
+        ]
+        [os.makedirs(s['dst_path'], exist_ok=True) for s in saves]
+        lock = threading.Lock()
+        active = []
+        max_active = []
+        events = []
+
+        def side_do_run(saver):
+            with lock:
+                active.append(saver.id)
+                max_active.append(len(active))
+                if saver.network_bound:
+                    events.append(('start', saver.id))
+            time.sleep(.1)
+            with lock:
+                active.remove(saver.id)
+                if saver.network_bound:
+                    events.append(('end', saver.id))
+
+        with patch.object(savers.google_cloud.GoogleDriveSaver, 'do_run', autospec=True, side_effect=side_do_run), \
+                patch.object(savers.google_cloud.GoogleContactsSaver, 'do_run', autospec=True, side_effect=side_do_run), \
+                patch.object(savers.file.FileSaver, 'do_run', autospec=True, side_effect=side_do_run), \
+                patch.object(save.SaveHandler, 'workers', 1), \
+                patch.object(save.SaveHandler, 'savers_per_volume', 4):
+            self._savegame(saves=saves)
+        self.assertEqual(max(max_active), 2)   # a network saver and a file saver
+        self.assertEqual(len(self.meta.data), 4)
+        # the savers sharing credentials never overlap
+        self.assertEqual([e[0] for e in events], ['start', 'end', 'start', 'end'])
+        self.assertEqual(events[0][1], events[1][1])
+
+
+class ScanCacheTestCase(BaseTestCase):
+    def test_walk(self):
+        root = os.path.join(self.src_root, 'src1')
+        for rel_path in ('file1', 'dir1/file2'):
+            file = os.path.join(root, rel_path)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'w') as fd:
+                fd.write(rel_path)
+        for path in (root, os.path.join(root, 'dir1')):
+            os.utime(path, (1, 1))
+        scan_cache = utils.ScanCache()
+        self.assertEqual({e.path for e in scan_cache.walk(root)}, {e.path for e in utils.walk_entries(root)})
+        with patch.object(os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            entries = list(scan_cache.walk(root))
+        self.assertFalse(mock_scandir.called)
+        self.assertEqual({os.path.relpath(e.path, root) for e in entries}, {'file1', 'dir1/file2'})
+
+        with open(os.path.join(root, 'dir1', 'file3'), 'w') as fd:
+            fd.write('file3')
+        with patch.object(os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            entries = list(scan_cache.walk(root))
+        self.assertEqual([c.args[0] for c in mock_scandir.call_args_list], [os.path.join(root, 'dir1')])
+        self.assertEqual({os.path.relpath(e.path, root) for e in entries}, {'file1', 'dir1/file2', 'dir1/file3'})
+
+    def test_storage(self):
+        root = os.path.join(self.src_root, 'src1')
+        os.makedirs(os.path.join(root, 'dir1'))
+        for path in (root, os.path.join(root, 'dir1')):
+            os.utime(path, (1, 1))
+        scan_cache = utils.ScanCache()
+        list(scan_cache.walk(root))
+        files = {f'file{i}': [1, i, 10, 100] for i in range(3)}
+        scan_cache.set_files('key1', files)
+        scan_cache.set_files('key2', {'file1': [2, 1, 10, 100]})
+        scan_cache.save()
+        with sqlite3.connect(scan_cache.file) as conn:
+            conn.execute("UPDATE files SET fingerprint = '[0]' WHERE key = 'key1' AND rel_path = 'file0'")
+        scan_cache.set_files('key1', files | {'file1': [1, 1, 20, 200]})   # only the changed rows are written
+
+        utils.ScanCache._instance = None
+        scan_cache = utils.ScanCache()
+        with patch.object(os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            list(scan_cache.walk(root))
+        self.assertFalse(mock_scandir.called)
+        self.assertEqual(scan_cache.get_files('key1'), {'file0': [0], 'file1': [1, 1, 20, 200], 'file2': [1, 2, 10, 100]})
+
+        with sqlite3.connect(scan_cache.file) as conn:
+            conn.execute("UPDATE savers SET ts = 0 WHERE key = 'key2'")
+        scan_cache.save()
+        utils.ScanCache._instance = None
+        self.assertEqual(utils.ScanCache().get_files('key2'), {})
+        self.assertEqual(len(utils.ScanCache().get_files('key1')), 3)
+
+    def test_saver(self):
+        src = os.path.join(self.src_root, 'src1')
+        src_file = os.path.join(src, 'file1')
+        os.makedirs(src)
+        with open(src_file, 'w') as fd:
+            fd.write('content1')
+        os.utime(src_file, (1, 1))
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves)
+        with patch.object(savers.base, 'compare_files') as mock_compare_files:
+            self._savegame(saves=saves, force=True)
+        mock_compare_files.assert_not_called()
+        dst_paths = self._list_dst_root_paths()
+        rf = list(self._list_save_ref_files(dst_paths).values())[0]
+        self.assertEqual(list(list(rf.values())[0].keys()), ['file1'])
+
+        with open(src_file, 'w') as fd:
+            fd.write('content2')
+        os.utime(src_file, (2, 2))
+        self._savegame(saves=saves, force=True)
+        dst_file = [f for f in self._list_dst_root_paths() if os.path.basename(f) == 'file1'][0]
+        with open(dst_file) as fd:
+            self.assertEqual(fd.read(), 'content2')
+
+        with open(dst_file, 'w') as fd:   # modified outside of savegame
+            fd.write('content3')
+        os.utime(dst_file, (1, 1))
+        self._savegame(saves=saves, force=True)
+        with open(dst_file) as fd:
+            self.assertEqual(fd.read(), 'content2')
+
+    def test_failed_ref_save(self):
+        src = os.path.join(self.src_root, 'src1')
+        src_file = os.path.join(src, 'file1')
+        os.makedirs(src)
+        with open(src_file, 'w') as fd:
+            fd.write('content1')
+        os.utime(src_file, (1, 1))
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        with patch.object(utils.SaveRef, 'save', side_effect=Exception('failed')):
+            self._savegame(saves=saves)
+        key, meta = list(self.meta.data.items())[0]
+        self.assertEqual(meta['success_ts'], 0)
+        self.assertEqual(utils.ScanCache().get_files(key), {})
+
+
+class CheckpointTestCase(BaseTestCase):
+    def test_resume(self):
+        src = os.path.join(self.src_root, 'src1')
+        os.makedirs(src)
+        for name in ('file1', 'file2', 'file3'):
+            file = os.path.join(src, name)
+            with open(file, 'w') as fd:
+                fd.write(name)
+            os.utime(file, (1, 1))
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        with patch.object(utils, 'CHECKPOINT_FILES', 2), \
+                patch.object(utils.SaveRef, 'save', side_effect=Exception('interrupted')):
+            self._savegame(saves=saves)
+        checkpoint_file = glob(os.path.join(WORK_DIR, '.checkpoint.*'))[0]
+        with open(checkpoint_file) as fd:
+            self.assertEqual([json.loads(r)[0] for r in fd], ['file1', 'file2', 'file3'])
+        self.assertEqual(len(self._list_save_ref_files(self._list_dst_root_paths())), 0)
+        with open(os.path.join(src, 'file3'), 'w') as fd:
+            fd.write('file3 updated')
+        os.utime(os.path.join(src, 'file3'), (2, 2))
+
+        utils.SaveRef._instances = {}
+        with patch.object(savers.base, 'compare_files', side_effect=savers.base.compare_files) as mock_compare_files:
+            self._savegame(saves=saves, force=True)
+        self.assertEqual([os.path.basename(c.args[0].src_file) for c in mock_compare_files.call_args_list], ['file3'])
+        self.assertFalse(os.path.exists(checkpoint_file))
+        rf = list(self._list_save_ref_files(self._list_dst_root_paths()).values())[0]
+        self.assertEqual(sorted(list(rf.values())[0].keys()), ['file1', 'file2', 'file3'])
+
+
+@unittest.skipIf(sys.platform != 'linux', 'linux only')
+class ChangeJournalTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        watcher.ChangeJournal._instance = None
+
+    def tearDown(self):
+        watcher.ChangeJournal().close()
+
+    def _wait_for_changes(self, key, root):
+        end_ts = time.time() + 5
+        while time.time() < end_ts:
+            if watcher.ChangeJournal().dirty_paths[key]:
+                break
+            time.sleep(.05)
+        time.sleep(.2)   # let the related events arrive
+        return watcher.ChangeJournal().get_dirty_paths(key, root)
+
+    def test_journal(self):
+        root = os.path.join(self.src_root, 'src1')
+        self._create_file(os.path.join(root, 'dir1', 'file1'), 'content1')
+        journal = watcher.ChangeJournal()
+        self.assertIsNone(journal.get_dirty_paths('key1', root))
+        self.assertEqual(journal.get_dirty_paths('key1', root), set())
+
+        self._create_file(os.path.join(root, 'dir1', 'file1'), 'content2')
+        self.assertEqual(self._wait_for_changes('key1', root), {os.path.join(root, 'dir1', 'file1')})
+        self._create_file(os.path.join(root, 'dir2', 'file2'), 'content2')
+        self.assertTrue(os.path.join(root, 'dir2') in self._wait_for_changes('key1', root))
+        self._create_file(os.path.join(root, 'dir2', 'file3'), 'content3')
+        self.assertEqual(self._wait_for_changes('key1', root), {os.path.join(root, 'dir2', 'file3')})
+
+        journal._on_change(None)
+        self.assertIsNone(journal.get_dirty_paths('key1', root))
+        self.assertEqual(journal.get_dirty_paths('key1', root), set())
+        journal.invalidate('key1')
+        self.assertIsNone(journal.get_dirty_paths('key1', root))
+
+    def test_prune(self):
+        root = os.path.join(self.src_root, 'src1')
+        for name in ('dir1/file1', 'excluded/dir2/file2'):
+            self._create_file(os.path.join(root, name), name)
+        journal = watcher.ChangeJournal()
+
+        def prune(path):
+            return os.path.basename(path) == 'excluded'
+
+        self.assertIsNone(journal.get_dirty_paths('key1', root, prune=prune))
+        self.assertEqual(set(journal.inotify.paths.values()), {root, os.path.join(root, 'dir1')})
+        self._create_file(os.path.join(root, 'dir3', 'excluded', 'file3'), 'content3')
+        end_ts = time.time() + 5
+        while os.path.join(root, 'dir3') not in journal.inotify.paths.values() and time.time() < end_ts:
+            time.sleep(.05)
+        time.sleep(.2)   # let the related events arrive
+        self.assertEqual(set(journal.inotify.paths.values()),
+                         {root, os.path.join(root, 'dir1'), os.path.join(root, 'dir3')})
+
+    def test_watch_limit(self):
+        root = os.path.join(self.src_root, 'src1')
+        self._create_file(os.path.join(root, 'dir1', 'file1'), 'content1')
+        journal = watcher.ChangeJournal()
+        error = watcher.WatchError('no space left on device', errno=errno.ENOSPC)
+        with patch.object(watcher.Inotify, 'add_tree', side_effect=error) as mock_add_tree, \
+                self.assertLogs(watcher.logger, level='WARNING') as cm:
+            for _ in range(3):
+                self.assertIsNone(journal.get_dirty_paths('key1', root))
+        self.assertEqual(mock_add_tree.call_count, 1)
+        self.assertEqual(len(cm.output), 1)
+        self.assertFalse('key1' in journal.roots)
+
+    def test_saver(self):
+        src = os.path.join(self.src_root, 'src1')
+        for name in ('file1', 'dir1/file2', 'dir2/file3'):
+            self._create_file(os.path.join(src, name), name)
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves, watch=True)
+        self._create_file(os.path.join(src, 'dir1', 'file2'), 'content2')
+        os.remove(os.path.join(src, 'dir2', 'file3'))
+        self._create_file(os.path.join(src, 'dir3', 'file4'), 'content4')
+        key = list(watcher.ChangeJournal().roots.keys())[0]
+        end_ts = time.time() + 5
+        while len(watcher.ChangeJournal().dirty_paths[key]) < 3 and time.time() < end_ts:
+            time.sleep(.05)
+        with patch.object(savers.base, 'compare_files', side_effect=compare.compare_files) as mock_compare_files:
+            self._savegame(saves=saves, force=True, watch=True)
+        self.assertEqual(sorted(os.path.basename(c.args[0].src_file) for c in mock_compare_files.call_args_list),
+                         ['file2', 'file4'])
+        dst_paths = self._list_dst_root_paths()
+        rf = list(self._list_save_ref_files(dst_paths).values())[0]
+        self.assertEqual(sorted(list(rf.values())[0].keys()), ['dir1/file2', 'dir3/file4', 'file1'])
+
+    def test_dst_file_removed(self):
+        src = os.path.join(self.src_root, 'src1')
+        for name in ('file1', 'dir1/file2'):
+            self._create_file(os.path.join(src, name), name)
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves, watch=True)
+        key = list(watcher.ChangeJournal().roots.keys())[0]
+        self.assertEqual(watcher.ChangeJournal().dirty_paths[key], set())
+        saver_dst = list(self._list_save_refs(self._list_dst_root_paths()).keys())[0]
+        dst_file = os.path.join(saver_dst, 'file1')
+        os.remove(dst_file)   # removed outside of savegame
+        for _ in range(2):
+            with patch.object(savers.base, 'compare_files', side_effect=compare.compare_files) as mock_compare_files:
+                self._savegame(saves=saves, force=True, watch=True)
+            self.assertTrue(os.path.exists(dst_file))
+        self.assertEqual(mock_compare_files.call_count, 0)
+
+
+class SaveRefIndexTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        remove_path(utils.SaveRefIndex(self.dst_root).file)
+        utils.SaveRefIndex._instances = {}
+
+    def _create_save_ref(self, dst, index=True):
+        save_ref = utils.SaveRef(dst)
+        os.makedirs(dst, exist_ok=True)
+        with open(os.path.join(dst, 'file1'), 'w') as fd:
+            fd.write('content1')
+        save_ref.set_file('src1', 'file1', 'ref1')
+        save_ref.save()
+        if index:   # as done by the savers
+            utils.SaveRefIndex(self.dst_root).set(dst)
+        return save_ref
+
+    def _iterate_dsts(self):
+        return [r.dst for r in utils.iterate_save_refs(self.dst_root)]
+
+    def test_1(self):
+        legacy_index_file = os.path.join(self.dst_root, utils.INDEX_FILENAME)
+        with open(legacy_index_file, 'w') as fd:
+            fd.write('{}')
+        dst1 = os.path.join(self.dst_root, 'host1', 'dst1')
+        self._create_save_ref(dst1)
+        self.assertEqual(self._iterate_dsts(), [dst1])
+        self.assertTrue(os.path.exists(utils.SaveRefIndex(self.dst_root).file))
+        self.assertFalse(os.path.exists(legacy_index_file))
+
+        dst2 = os.path.join(self.dst_root, 'host1', 'dst2')
+        self._create_save_ref(dst2)
+        utils.SaveRefIndex._instances = {}
+        with patch.object(utils, 'walk_entries') as mock_walk_entries:
+            self.assertEqual(self._iterate_dsts(), [dst1, dst2])
+        mock_walk_entries.assert_not_called()
+
+        remove_path(dst1)
+        with patch.object(utils, 'walk_entries') as mock_walk_entries:
+            self.assertEqual(self._iterate_dsts(), [dst2])
+        mock_walk_entries.assert_not_called()
+
+        # created by another host, the index files are not shared
+        dst3 = os.path.join(self.dst_root, 'host2', 'dst3')
+        self._create_save_ref(dst3, index=False)
+        self.assertEqual(self._iterate_dsts(), [dst2, dst3])
+        dst4 = os.path.join(self.dst_root, 'host2', 'dst4')
+        self._create_save_ref(dst4, index=False)
+        self.assertEqual(self._iterate_dsts(), [dst2, dst3, dst4])
+        self.assertFalse([f for f in os.listdir(self.dst_root) if f.startswith(utils.REF_FILENAME)])
+
+    def test_root_limit(self):
+        dst = os.path.join(self.dst_root, 'host1', 'dst1')
+        self._create_save_ref(dst)
+        self.assertEqual(self._iterate_dsts(), [dst])
+        with patch.object(os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            self.assertEqual(self._iterate_dsts(), [dst])
+        self.assertEqual(sorted(c.args[0] for c in mock_scandir.call_args_list),
+                         [self.dst_root, os.path.join(self.dst_root, 'host1')])
+
+
+class DeltaCopyTestCase(BaseTestCase):
+    def _read(self, file):
+        with open(file, 'rb') as fd:
+            return fd.read()
+
+    def test_delta_copy_file(self):
+        src_file = os.path.join(self.src_root, 'file1')
+        dst_file = os.path.join(self.dst_root, 'file1')
+        data = bytearray(b''.join(bytes([i]) * 100 for i in range(5)))
+        self._create_file(src_file, data)
+        fr, blocks = copier.delta_copy_file(src_file, dst_file, [], block_size=100)
+        self.assertEqual(self._read(dst_file), data)
+        self.assertEqual(len(blocks), 5)
+        self.assertEqual(fr.hash, utils.get_file_hash(src_file, use_cache=False))
+
+        data[250] = 255
+        data += b'end'
+        self._create_file(src_file, data)
+        fr, blocks2 = copier.delta_copy_file(src_file, dst_file, blocks, block_size=100)
+        self.assertEqual(self._read(dst_file), data)
+        self.assertEqual(len(blocks2), 6)
+        self.assertEqual([i for i, (b1, b2) in enumerate(zip(blocks, blocks2)) if b1 != b2], [2])
+
+        data = data[:150]
+        self._create_file(src_file, data)
+        fr, blocks3 = copier.delta_copy_file(src_file, dst_file, blocks2, block_size=100)
+        self.assertEqual(self._read(dst_file), data)
+        self.assertEqual(len(blocks3), 2)
+
+    def test_saver(self):
+        src = os.path.join(self.src_root, 'src1')
+        src_file = os.path.join(src, 'file1')
+        self._create_file(src_file, b'0' * 3 * copier.DELTA_BLOCK_SIZE)
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+                'delta_size_threshold': 1000,
+                'purge_delta': 0,
+            },
+        ]
+        with patch.object(savers.base, 'delta_copy_file') as mock_delta_copy_file:
+            self._savegame(saves=saves)
+        mock_delta_copy_file.assert_not_called()   # no dst yet
+        dst_paths = self._list_dst_root_paths()
+        dst_file = [f for f in dst_paths if os.path.basename(f) == 'file1'][0]
+        blocks_file = os.path.join(os.path.dirname(dst_file), utils.BLOCKS_FILENAME)
+        self.assertTrue(blocks_file in dst_paths)   # recorded while copied
+
+        self._create_file(src_file, b'0' * 2 * copier.DELTA_BLOCK_SIZE + b'1' * copier.DELTA_BLOCK_SIZE)
+        with patch.object(savers.base, 'copy_file') as mock_copy_file:
+            self._savegame(saves=saves)
+        mock_copy_file.assert_not_called()
+        self.assertEqual(self._read(dst_file), self._read(src_file))
+        self.assertTrue(os.path.exists(blocks_file))
+        with open(blocks_file) as fd:
+            blocks = json.load(fd)['file1']['blocks']
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(blocks[0], blocks[1])
+        self.assertNotEqual(blocks[1], blocks[2])
+
+        os.remove(blocks_file)
+        utils.BlockRef._instances = {}
+        self._create_file(src_file, b'2' * 3 * copier.DELTA_BLOCK_SIZE)
+        with patch.object(savers.base, 'delta_copy_file') as mock_delta_copy_file:
+            self._savegame(saves=saves)
+        mock_delta_copy_file.assert_not_called()   # unknown dst blocks
+        self.assertEqual(self._read(dst_file), self._read(src_file))
+        self.assertTrue(os.path.exists(blocks_file))
+
+
+class CompareTestCase(BaseTestCase):
+    def _compare(self, file1, file2, method='hash'):
+        return compare.compare_files(compare.FileComparison(file1, file2), method)
+
+    def test_stages(self):
+        file1 = self._create_file('file1', b'content1')
+        self.assertEqual(self._compare(file1, os.path.join(self.dst_root, 'missing')), (False, 'exists'))
+        self.assertEqual(self._compare(file1, self._create_file('file2', b'content22')), (False, 'size'))
+        self.assertEqual(self._compare(file1, shutil.copy2(file1, os.path.join(self.dst_root, 'file3'))), (True, 'mtime'))
+        file4 = self._create_file('file4', b'content4')
+        os.utime(file4, (0, 0))
+        self.assertEqual(self._compare(file1, file4), (False, 'sample'))
+        self.assertEqual(self._compare(file1, shutil.copy(file1, os.path.join(self.dst_root, 'file5'))), (True, 'sample'))
+
+    def test_shallow_mtime_drift(self):
+        file1 = self._create_file('file1', b'content1')
+        file2 = self._create_file('file2', b'content2')
+        mtime = os.stat(file1).st_mtime
+        os.utime(file2, (mtime - 1, mtime - 1))   # edited within the drift tolerance
+        self.assertEqual(self._compare(file1, file2, method='shallow'), (False, 'sample'))
+        file3 = shutil.copy2(file1, os.path.join(self.dst_root, 'file3'))
+        self.assertEqual(self._compare(file1, file3, method='shallow'), (True, 'mtime'))
+
+    def test_ref(self):
+        file1 = self._create_file('file1', b'content1')
+        file2 = shutil.copy(file1, os.path.join(self.dst_root, 'file2'))
+        os.utime(file2, (0, 0))
+        ref = utils.FileRef(hash=utils.get_file_hash(file1), fingerprint=utils.get_fingerprint(os.stat(file2))).ref
+        res = compare.compare_files(compare.FileComparison(file1, file2, ref=ref))
+        self.assertEqual(res, (True, 'ref'))
+
+        ref = utils.FileRef(hash='123', fingerprint=utils.get_fingerprint(os.stat(file2))).ref
+        res = compare.compare_files(compare.FileComparison(file1, file2, ref=ref))
+        self.assertEqual(res, (False, 'ref'))
+
+        with open(file2, 'wb') as fd:
+            fd.write(b'content2')
+        os.utime(file2, (1, 1))
+        res = compare.compare_files(compare.FileComparison(file1, file2, ref=ref))
+        self.assertEqual(res, (False, 'sample'))
+
+    def test_large_file(self):
+        size = 4 * compare.SAMPLE_SIZE
+        file1 = self._create_file('file1', b'0' * size)
+        file2 = self._create_file('file2', b'0' * compare.SAMPLE_SIZE + b'1' + b'0' * (size - compare.SAMPLE_SIZE - 1))
+        os.utime(file2, (0, 0))
+        self.assertEqual(self._compare(file1, file2), (False, 'hash'))
+        self.assertEqual(self._compare(file1, file2, method='shallow'), (False, 'content'))
+        file3 = shutil.copy(file1, os.path.join(self.dst_root, 'file3'))
+        os.utime(file3, (0, 0))
+        self.assertEqual(self._compare(file1, file3), (True, 'hash'))
+
+
+class SaveRefTestCase(BaseTestCase):
     def test_1(self):
         src1 = os.path.join(self.src_root, 'src1')
         src2 = os.path.join(self.src_root, 'src2')
@@ -396,6 +1374,7 @@ class SaveRefTestCase(BaseTestCase):
         self.assertEqual(files, {})
         s2.set_file(src1, 'file4', 'hash4', hostname=hostname2)
         self.assertEqual(s2.get_files(src1, hostname=hostname2), {'file4': 'hash4'})
+        self._create_file(os.path.join(dst1, 'file4'), 'content4')
         s2.save(hostname=hostname2)
         self.assertEqual(s2.get_files(hostname=hostname2), {src1: {'file4': 'hash4'}})
 
@@ -413,13 +1392,177 @@ class SaveRefTestCase(BaseTestCase):
         os.remove(os.path.join(dst1, 'file1'))
         s1.save()
         self.assertEqual(s1.get_files(src1), {'file2': 'hash2', 'file4': 'hash4'})
-        data1 = deepcopy(s1.data)
-        pprint(data1)
-
         utils.SaveRef._instances = {}
         s3 = utils.SaveRef(dst1)
         self.assertNotEqual(s3, s1)
-        self.assertEqual(s3.data, data1)
+        self.assertEqual(s3.get_hostnames(), sorted([HOSTNAME, hostname2]))
+        self.assertEqual(s3.get_files(), {src1: {'file2': 'hash2', 'file4': 'hash4'}, src2: {'file2': 'hash2', 'file3': 'hash3'}})
+        self.assertEqual(s3.get_files(hostname=hostname2), {src1: {'file4': 'hash4'}})
+        self.assertEqual(s3.get_ts(), s1.get_ts())
+
+    def test_migration(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        os.makedirs(dst)
+        for name in ('file1', 'file2'):
+            with open(os.path.join(dst, name), 'w') as fd:
+                fd.write(name)
+        data = {
+            'files': {HOSTNAME: {'src1': {'file1': 'ref1'}}, 'hostname2': {'src2': {'file2': 'ref2'}}},
+            'ts': {HOSTNAME: 123, 'hostname2': 456},
+            'version': utils.SaveRef._json_version,
+        }
+        ref_file = os.path.join(dst, utils.REF_FILENAME)
+        with open(ref_file, 'w') as fd:
+            json.dump(data, fd)
+        save_ref = utils.SaveRef(dst)
+        with open(ref_file, 'rb') as fd:
+            self.assertEqual(fd.read(len(utils.SQLITE_HEADER)), utils.SQLITE_HEADER)
+        self.assertTrue(os.path.exists(os.path.join(dst, utils.get_shard_filename('hostname2'))))
+        self.assertEqual(save_ref.get_hostnames(), sorted([HOSTNAME, 'hostname2']))
+        self.assertEqual(save_ref.get_files(), {'src1': {'file1': 'ref1'}})
+        self.assertEqual(save_ref.get_files(hostname='hostname2'), {'src2': {'file2': 'ref2'}})
+        self.assertEqual(save_ref.get_ts(hostname='hostname2'), 456)
+
+        utils.SaveRef._instances = {}
+        with open(ref_file, 'w') as fd:
+            json.dump(dict(data, version='old'), fd)
+        save_ref = utils.SaveRef(dst)
+        self.assertFalse(os.path.exists(ref_file))
+        self.assertEqual(save_ref.get_files(), {})
+
+    def test_shards(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        for name in ('file1', 'file2'):
+            self._create_file(os.path.join(dst, name), name)
+        save_ref = utils.SaveRef(dst)
+        save_ref.set_file('src1', 'file1', 'hash1')
+        save_ref.save()
+        shard_file = os.path.join(dst, utils.get_shard_filename(HOSTNAME))
+        shard_file2 = os.path.join(dst, utils.get_shard_filename('hostname2'))
+        self.assertFalse(os.path.exists(shard_file2))
+        os.utime(shard_file, (1, 1))
+
+        save_ref.set_file('src2', 'file2', 'hash2', hostname='hostname2')
+        save_ref.save(hostname='hostname2')
+        self.assertEqual(os.path.getmtime(shard_file), 1)
+        self.assertTrue(os.path.exists(shard_file2))
+        save_ref.save()
+        self.assertEqual(os.path.getmtime(shard_file), 1)
+
+        utils.SaveRef._instances = {}
+        save_ref = utils.SaveRef(dst)
+        self.assertEqual(save_ref.get_hostnames(), sorted([HOSTNAME, 'hostname2']))
+        self.assertEqual(save_ref.get_files(), {'src1': {'file1': 'hash1'}})
+        self.assertEqual(save_ref.get_files(hostname='hostname2'), {'src2': {'file2': 'hash2'}})
+        self.assertEqual(utils.parse_shard_filename(utils.get_shard_filename('host.name')), 'host.name')
+        self.assertIsNone(utils.parse_shard_filename(utils.BLOCKS_FILENAME))
+        self.assertTrue(utils.is_ref_file(f'{utils.get_shard_filename(HOSTNAME)}-journal'))
+
+    def test_corrupted_header(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        self._create_file(os.path.join(dst, 'file1'), 'file1')
+        save_ref = utils.SaveRef(dst)
+        save_ref.set_file('src1', 'file1', 'hash1')
+        save_ref.save()
+        with open(save_ref.file, 'wb') as fd:
+            fd.write(utils.SQLITE_HEADER + b'corrupted')
+
+        utils.SaveRef._instances = {}
+        save_ref = utils.SaveRef(dst)
+        self.assertEqual(save_ref.get_files(), {'src1': {'file1': 'hash1'}})
+        utils.SaveRef._instances = {}
+        self.assertEqual(utils.SaveRef(dst).get_files(), {'src1': {'file1': 'hash1'}})
+
+    def test_invalid_header(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        self._create_file(os.path.join(dst, 'file1'), 'file1')
+        save_ref = utils.SaveRef(dst)
+        save_ref.set_file('src1', 'file1', 'hash1')
+        save_ref.set_file('src2', 'file1', 'hash2', hostname='hostname2')
+        save_ref.save()
+        save_ref.save(hostname='hostname2')
+        for content in (b'', b'{"files": {', utils.SQLITE_HEADER[:4]):
+            with open(save_ref.file, 'wb') as fd:
+                fd.write(content)
+            utils.SaveRef._instances = {}
+            save_ref = utils.SaveRef(dst)
+            self.assertEqual(save_ref.get_files(), {'src1': {'file1': 'hash1'}})
+            self.assertEqual(save_ref.get_files(hostname='hostname2'), {'src2': {'file1': 'hash2'}})
+            with open(save_ref.file, 'rb') as fd:
+                self.assertEqual(fd.read(len(utils.SQLITE_HEADER)), utils.SQLITE_HEADER)
+        self.assertEqual(sorted(os.listdir(dst)), sorted(['file1', utils.REF_FILENAME, utils.get_shard_filename(HOSTNAME),
+                                                          utils.get_shard_filename('hostname2')]))
+
+    def test_locked_header(self):
+        src = os.path.join(self.src_root, 'src1')
+        self._create_file(os.path.join(src, 'file1'), 'file1')
+        saves = [{'src_paths': [src], 'dst_path': os.path.join(self.dst_root, f'dst{i}')} for i in (1, 2)]
+        [os.makedirs(s['dst_path']) for s in saves]
+        self._savegame(saves=saves)
+        self.assertEqual(len(self.meta.data), 2)
+        dst1 = [d['dst'] for d in self.meta.data.values() if d['dst'].startswith(saves[0]['dst_path'])][0]
+        self.meta.data = {}
+
+        utils.SaveRef._instances = {}
+        connect = sqlite3.connect
+        conn = connect(os.path.join(dst1, utils.REF_FILENAME))
+        conn.execute('BEGIN EXCLUSIVE')
+        try:
+            with patch.object(utils.sqlite3, 'connect', side_effect=lambda *a, **k: connect(*a, timeout=0)):
+                self.assertRaises(utils.SaveRefError, utils.SaveRef, dst1)
+                self.assertNotIn(dst1, utils.SaveRef._instances)
+                self._savegame(saves=saves, force=True)
+        finally:
+            conn.rollback()
+            conn.close()
+        self.assertEqual(len(self.meta.data), 1)   # the other saver still ran
+        self.assertNotEqual(list(self.meta.data.values())[0]['dst'], dst1)
+        self.assertEqual(list(utils.SaveRef(dst1).get_files(src)), ['file1'])
+
+    def test_purge_files(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        rel_paths = ['file1', 'file2', 'dir1/file3', 'dir1/file4', 'dir2/file5']
+        for rel_path in rel_paths:
+            self._create_file(os.path.join(dst, rel_path), rel_path)
+        save_ref = utils.SaveRef(dst)
+        for rel_path in rel_paths:
+            save_ref.set_file('src1', rel_path, 'hash')
+        save_ref.save()
+        os.remove(os.path.join(dst, 'dir1', 'file3'))
+        remove_path(os.path.join(dst, 'dir2'))
+
+        with patch.object(utils.os, 'listdir', side_effect=os.listdir) as mock_listdir:
+            save_ref.save()
+        self.assertEqual(sorted(c.args[0] for c in mock_listdir.call_args_list),
+                         sorted([dst, os.path.join(dst, 'dir1'), os.path.join(dst, 'dir2')]))
+        self.assertEqual(sorted(save_ref.get_files('src1')), ['dir1/file4', 'file1', 'file2'])
+
+        with patch.object(utils.os, 'listdir') as mock_listdir:
+            save_ref.save(dst_files={os.path.join(dst, 'file1')})
+        mock_listdir.assert_not_called()
+        self.assertEqual(sorted(save_ref.get_files('src1')), ['file1'])
+
+    def test_views(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        for name in ('file1', 'file2'):
+            self._create_file(os.path.join(dst, name), name)
+        save_ref = utils.SaveRef(dst)
+        save_ref.set_file('src1', 'file1', 'hash1')
+        save_ref.save()
+
+        files = save_ref.reset_files('src1')
+        save_ref.set_file('src1', 'file2', 'hash2')
+        self.assertEqual(files, {'file1': 'hash1'})
+        view = save_ref.get_files('src1')
+        self.assertEqual(view, {'file2': 'hash2'})
+        with self.assertRaises(TypeError):
+            view['file3'] = 'hash3'
+        save_ref.set_file('src1', 'file1', 'hash1')
+        self.assertEqual(view, {'file1': 'hash1', 'file2': 'hash2'})
+        self.assertEqual(sorted(save_ref.iterate_files()), [('src1', 'file1', 'hash1'), ('src1', 'file2', 'hash2')])
+        save_ref.save()
+        self.assertEqual(sorted(save_ref.iterate_files('src1')), [('src1', 'file1', 'hash1'), ('src1', 'file2', 'hash2')])
+        self.assertEqual(list(save_ref.iterate_files('src2')), [])
 
 
 class SaveItemTestCase(BaseTestCase):
@@ -566,6 +1709,44 @@ class SavegameTestCase(BaseTestCase):
         self.assertFalse(any_str_matches(dst_paths, '*dir3*'))
         self.assertFalse(any_str_matches(dst_paths, '*file3*'))
 
+    def test_time_budget(self):
+        self._generate_src_data(index_start=1, nb_srcs=3, nb_dirs=1, nb_files=1)
+        saves = [
+            {
+                'src_paths': [os.path.join(self.src_root, f'src{i}') for i in range(1, 4)],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves)
+        meta = {d['src']: d for d in self.meta.data.values()}
+        src1, src2, src3 = [os.path.join(self.src_root, f'src{i}') for i in range(1, 4)]
+        meta[src1].update({'start_ts': 0, 'end_ts': 1000})
+        meta[src2].update({'next_ts': time.time() - 3600 * 24})
+        for data in meta.values():
+            data['next_ts'] = min(data['next_ts'], time.time() - 1)
+
+        run_srcs = []
+        orig_run = savers.base.BaseSaver.run
+
+        def side_run(saver):
+            run_srcs.append(saver.src)
+            return orig_run(saver)
+
+        with patch.object(savers.base.BaseSaver, 'run', autospec=True, side_effect=side_run), \
+                patch.object(save.SaveHandler, 'workers', 1):
+            self._savegame(saves=saves, time_budget=10)
+        self.assertEqual(run_srcs, [src2, src3])
+        meta = {d['src']: d for d in self.meta.data.values()}
+        self.assertEqual(meta[src1]['end_ts'], 1000)
+        self.assertTrue(meta[src2]['end_ts'] > 1000)
+
+        run_srcs.clear()
+        with patch.object(savers.base.BaseSaver, 'run', autospec=True, side_effect=side_run), \
+                patch.object(save.SaveHandler, 'workers', 1):
+            self._savegame(saves=saves)
+        self.assertEqual(run_srcs[0], src1)   # the most overdue
+        self.assertEqual(sorted(run_srcs), [src1, src2, src3])
+
     def test_save(self):
         self._generate_src_data(index_start=1, nb_srcs=3, nb_dirs=3, nb_files=3)
         saves = [
@@ -630,7 +1811,7 @@ class SavegameTestCase(BaseTestCase):
         def side_copy(*args, **kwargs):
             raise Exception('copy failed')
 
-        with patch.object(module.savers.file.shutil, 'copy2', side_effect=side_copy):
+        with patch.object(module.savers.base, 'copy_file', side_effect=side_copy):
             self._savegame(saves=saves)
         rf2 = self._get_save_refs()[src1].get_files(src1)
         pprint(rf2)
@@ -654,7 +1835,8 @@ class SavegameTestCase(BaseTestCase):
         self._savegame(saves=saves)
         rf4 = self._get_save_refs()[src1].get_files(src1)
         pprint(rf4)
-        self.assertEqual(rf4, rf3)
+        self.assertEqual({k: utils.FileRef.from_ref(v).hash for k, v in rf4.items()},
+                         {k: utils.FileRef.from_ref(v).hash for k, v in rf3.items()})
 
         dst_paths = self._list_dst_root_paths()
         self.assertTrue(any_str_matches(dst_paths, '*dir1/file1*'))
@@ -766,6 +1948,36 @@ class SavegameTestCase(BaseTestCase):
         src_paths2 = self._list_src_root_paths()
         self.assertEqual(src_paths2, src_paths)
 
+    def test_purge_dirs(self):
+        self._generate_src_data(index_start=1, nb_srcs=1, nb_dirs=2, nb_files=2)
+        src = os.path.join(self.src_root, 'src1')
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+                'purge_delta': 300,
+            },
+        ]
+        self._savegame(saves=saves)
+        dst = self._get_save_refs()[src].dst
+        os.makedirs(os.path.join(dst, 'empty1', 'empty2'))
+        old_file = os.path.join(dst, 'old', 'file')
+        recent_file = os.path.join(dst, 'recent', 'file')
+        for file in (old_file, recent_file):
+            os.makedirs(os.path.dirname(file))
+            with open(file, 'w') as fd:
+                fd.write('data')
+        os.utime(old_file, (1, 1))
+        dst_paths = self._list_dst_root_paths()
+
+        self._savegame(saves=saves)
+        dst_paths2 = self._list_dst_root_paths()
+        self.assertEqual(dst_paths - dst_paths2, {old_file, os.path.dirname(old_file), os.path.join(dst, 'empty1'),
+                                                  os.path.join(dst, 'empty1', 'empty2')})
+        self.assertTrue(os.path.exists(recent_file))
+        self.assertTrue(os.path.exists(os.path.join(dst, utils.REF_FILENAME)))
+        self.assertTrue(os.path.exists(os.path.join(dst, utils.get_shard_filename(HOSTNAME))))
+
     def test_src_path_patterns(self):
         self._generate_src_data(index_start=1, nb_srcs=2, nb_dirs=3, nb_files=3)
         saves = [
@@ -1226,7 +2438,7 @@ class LoadgameTestCase(BaseTestCase):
         dst_paths = self._list_dst_root_paths()
         ref_file = [f for f in dst_paths if os.path.basename(f) == utils.REF_FILENAME][0]
         ref = utils.SaveRef(os.path.dirname(ref_file))
-        pprint(ref.data)
+        pprint(ref.get_files())
 
         shutil.rmtree(src_path)
         self._loadgame()
@@ -1262,6 +2474,67 @@ class FileTestCase(BaseTestCase):
         })
         self.assertTrue(all(bool(v) for v in rf.values()))
 
+    def test_src_file_removed(self):
+        self._generate_src_data(index_start=1, nb_srcs=1, nb_dirs=1, nb_files=2)
+        src = os.path.join(self.src_root, 'src1')
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves)
+        removed_file = os.path.join(src, 'dir1', 'file1')
+        with open(removed_file) as fd:
+            content = fd.read()
+        with open(removed_file, 'w') as fd:
+            fd.write(content[::-1])   # same size, so the src file gets hashed
+        orig_get_src_and_files = savers.file.FileSaver._get_src_and_files
+
+        def side_get_src_and_files(saver):
+            res = orig_get_src_and_files(saver)
+            os.remove(removed_file)   # removed between the listing and the compare
+            return res
+
+        reports = []
+        with patch.object(savers.file.FileSaver, '_get_src_and_files', autospec=True,
+                          side_effect=side_get_src_and_files), \
+                patch.object(save.SaveReport, 'print_table', autospec=True,
+                             side_effect=lambda report, **kwargs: reports.append(report)):
+            self._savegame(saves=saves, force=True)
+        self.assertEqual([(r['rel_path'], r['code']) for r in reports[0].data], [('dir1/file1', 'failed')])
+        meta = list(self.meta.data.values())[0]
+        self.assertEqual(meta['success_ts'], meta['end_ts'])
+
+    def test_report_stages(self):
+        self._generate_src_data(index_start=1, nb_srcs=1, nb_dirs=1, nb_files=3)
+        src = os.path.join(self.src_root, 'src1')
+        saves = [
+            {
+                'src_paths': [src],
+                'dst_path': self.dst_root,
+            },
+        ]
+        self._savegame(saves=saves)
+        file1, file2 = os.path.join(src, 'dir1', 'file1'), os.path.join(src, 'dir1', 'file2')
+        with open(file1, 'a') as fd:
+            fd.write('new data')
+        with open(file2) as fd:
+            content = fd.read()
+        with open(file2, 'w') as fd:
+            fd.write(content[::-1])
+        with open(os.path.join(src, 'dir1', 'file4'), 'w') as fd:
+            fd.write('content4')
+        reports = []
+        with patch.object(save.SaveReport, 'print_table', autospec=True,
+                          side_effect=lambda report, **kwargs: reports.append(report)):
+            self._savegame(saves=saves, force=True)
+        self.assertEqual(sorted((r['rel_path'], r['code'], r['stage']) for r in reports[0].data), [
+            ('dir1/file1', 'saved', 'size'),
+            ('dir1/file2', 'saved', 'ref'),
+            ('dir1/file4', 'saved', 'exists'),
+        ])
+
     def test_dst_files_are_newer(self):
         self._generate_src_data(index_start=1, nb_srcs=2, nb_dirs=2, nb_files=2)
         saves = [
@@ -1434,9 +2707,10 @@ class FileTestCase(BaseTestCase):
 
         other_src = 'D:\\data\\src1'
         other_files = {'dir1\\file1': 123, 'dir1\\file2': 123}
-        other_data = {'files': {'other_hostname': {other_src: other_files}}, 'ts': {'other_hostname': 123}}
         save_ref = utils.SaveRef(dst)
-        save_ref._load(other_data)
+        for rel_path, ref in other_files.items():
+            save_ref.set_file(other_src, rel_path, ref, hostname='other_hostname')
+        save_ref.save(hostname='other_hostname')
         self._list_save_ref_files(dst_paths)[dst]
 
         self._savegame(saves=saves)
@@ -1503,11 +2777,6 @@ class FileTestCase(BaseTestCase):
 
 
 class GitTestCase(BaseTestCase):
-    def _create_file(self, file, content):
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        with open(file, 'w') as fd:
-            fd.write(content)
-
     def _create_repo(self, repo_dirname):
         repo_dir = os.path.join(self.src_root, repo_dirname)
         subprocess.run(['git', 'init', repo_dir], check=True)
@@ -1573,8 +2842,10 @@ class GoogleDriveTestCase(BaseTestCase):
             ]
 
         def export_file(file_id, path, mime_type):
+            data = f'{file_id=} {mime_type=} {dt.isoformat()=}'
             with open(path, 'w') as fd:
-                fd.write(f'{file_id=} {mime_type=} {dt.isoformat()=}')
+                fd.write(data)
+            return utils.get_hash(data)
 
         return Mock(iterate_file_meta=iterate_file_meta, export_file=export_file)
 
@@ -1588,8 +2859,10 @@ class GoogleDriveTestCase(BaseTestCase):
         ]
         [os.makedirs(s['dst_path'], exist_ok=True) for s in saves]
         dt = datetime.now(timezone.utc) - timedelta(seconds=10)
-        with patch.object(savers.google_cloud, 'get_google_cloud', return_value=self._get_google_cloud(dt)):
+        with patch.object(savers.google_cloud, 'get_google_cloud', return_value=self._get_google_cloud(dt)), \
+                patch.object(utils, 'get_file_hash', side_effect=utils.get_file_hash) as mock_get_file_hash:
             self._savegame(saves)
+        mock_get_file_hash.assert_not_called()   # hashed while exported
         dst_paths = self._list_dst_root_paths()
         self.assertTrue(any_str_matches(dst_paths, '*google_drive/file1*'))
         save_ref = list(self._list_save_refs(dst_paths).values())[0]
@@ -1612,6 +2885,26 @@ class GoogleDriveTestCase(BaseTestCase):
         pprint(fr3)
         self.assertNotEqual(fr3, fr1)
 
+    def test_large_file(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        os.makedirs(dst)
+        saves = [
+            {
+                'saver_id': 'google_drive',
+                'dst_path': dst,
+            },
+        ]
+        dt = datetime.now(timezone.utc) - timedelta(seconds=10)
+        refs = []
+        with patch.object(utils, 'MAX_HASH_FILE_SIZE', 10), patch.object(utils, 'TREE_HASH_CHUNK_SIZE', 10):
+            for _ in range(2):   # exported, then unchanged
+                with patch.object(savers.google_cloud, 'get_google_cloud', return_value=self._get_google_cloud(dt)):
+                    self._savegame(saves)
+                save_ref = list(self._list_save_refs(self._list_dst_root_paths()).values())[0]
+                refs.append(dict(save_ref.get_files(hostname='google_cloud')['google_drive']))
+        self.assertTrue(utils.is_tree_hash(utils.FileRef.from_ref(refs[0]['file1']).hash))
+        self.assertEqual(refs[1], refs[0])
+
 
 class GoogleContactsTestCase(BaseTestCase):
     def _get_google_cloud(self, nb_contacts=10):
@@ -1715,6 +3008,30 @@ class VirtualboxTestCase(BaseTestCase):
         self.assertTrue(rf2['ub1.ova'] != rf['ub1.ova'])
         self.assertTrue(rf2['ub2.ova'] != rf['ub2.ova'])
 
+    def test_tree_hash(self):
+        dst = os.path.join(self.dst_root, 'dst1')
+        saves = [
+            {
+                'saver_id': 'virtualbox',
+                'dst_path': dst,
+            },
+        ]
+        os.makedirs(dst, exist_ok=True)
+        with patch.object(utils, 'MAX_HASH_FILE_SIZE', 5), \
+                patch.object(utils, 'TREE_HASH_CHUNK_SIZE', 4):
+            self._run(saves, [], ['ub1'])
+        dst_paths = self._list_dst_root_paths()
+        ref = self._list_save_ref_files(dst_paths)[dst]['virtualbox']['ub1.ova']
+        self.assertTrue(utils.is_tree_hash(utils.FileRef.from_ref(ref).hash))
+        self.assertEqual(len(utils.BlockRef(dst).get_blocks('ub1.ova', 4)), 2)
+        monitor = save.SaveMonitor(self.config)
+        save_ref = utils.SaveRef(dst)
+        self.assertIsNone(monitor._check_file('virtualbox', save_ref, 'virtualbox', 'ub1.ova', ref))
+        with open(os.path.join(dst, 'ub1.ova'), 'w') as fd:
+            fd.write('ub1 dat4')
+        utils.HashCache().data = {}
+        self.assertTrue(monitor._check_file('virtualbox', save_ref, 'virtualbox', 'ub1.ova', ref).startswith('conflicting'))
+
 
 class ManySourcesTestCase(BaseTestCase):
     def test_1(self):